@@ -1,28 +1,54 @@
 import json
 import boto3
 import os
+import queue
+import random
 from datetime import datetime, timedelta
 from decimal import Decimal
 import math
 import hashlib
 import hmac
 import base64
+import concurrent.futures
+import contextlib
+import csv
+import gzip
+import io
 import secrets
 import string
+import tempfile
+import threading
+import time
+import uuid
 import urllib.request
 import urllib.parse
 import urllib.error
 import stripe
 import requests
 
+# Optional: only needed to bill from Parquet S3 Inventory reports
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
 # Initialize AWS clients
 dynamodb = boto3.resource('dynamodb')
 s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
 table = dynamodb.Table('frontend-users')
 billing_table = dynamodb.Table('billing-admins')
 billing_user_from_tenant_table = dynamodb.Table('billinguser-from-tenant-dev')
+storage_usage_table = dynamodb.Table(os.environ.get('STORAGE_USAGE_TABLE', 'tenant-storage-usage'))
+token_balance_shards_table = dynamodb.Table(os.environ.get('TOKEN_BALANCE_SHARDS_TABLE', 'token-balance-shards'))
+usage_ledger_table = dynamodb.Table(os.environ.get('USAGE_LEDGER_TABLE', 'usage-ledger'))
+job_claims_table = dynamodb.Table(os.environ.get('JOB_CLAIMS_TABLE', 'async-job-claims'))
+stripe_events_table = dynamodb.Table(os.environ.get('STRIPE_EVENTS_TABLE', 'stripe-webhook-events'))
+rate_limit_table = dynamodb.Table(os.environ.get('RATE_LIMIT_TABLE', 'rate-limit-buckets'))
+billing_runs_table = dynamodb.Table(os.environ.get('BILLING_RUNS_TABLE', 'storage-billing-runs'))
 bucket_name = os.environ['BUCKET_NAME']
 openai_api_key = os.environ.get('OPENAI_API_KEY')
+openai_api_base = os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1').rstrip('/')
 google_client_id = os.environ.get('GOOGLE_CLIENT_ID')
 google_client_secret = os.environ.get('GOOGLE_CLIENT_SECRET')
 stripe_secret_key = os.environ.get('STRIPE_SECRET_KEY')
@@ -30,8 +56,37 @@ stripe_webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET')
 stripe_initial_payment_url = os.environ.get('STRIPE_INITIAL_PAYMENT_URL')
 stripe_customer_portal_url = os.environ.get('STRIPE_CUSTOMER_PORTAL_URL')
 stripe_product_id = os.environ.get('STRIPE_PRODUCT_ID')
+# How long a Stripe account status cached on the billing-admins item is served without asking Stripe again
+stripe_account_status_ttl_seconds = int(os.environ.get('STRIPE_ACCOUNT_STATUS_TTL_SECONDS', '300'))
 payment_enforced = os.environ.get('PAYMENT_ENABLED', 'false').lower() != 'false'  # Default to false for demo, set to 'true' to enforce
 billing_passkey_hash = os.environ.get('BILLING_PASSKEY_HASH')
+lambda_function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+# 'aws' stores jobs in S3 and self-invokes a worker; 'local' keeps jobs in memory and runs the worker on a thread
+async_job_backend = os.environ.get('ASYNC_JOB_BACKEND', 'aws').lower()
+# Matches the function timeout: a job still 'running' after this long lost its worker
+async_job_timeout_seconds = int(os.environ.get('ASYNC_JOB_TIMEOUT_SECONDS', '300'))
+llm_preload_batch_concurrency = int(os.environ.get('LLM_PRELOAD_BATCH_CONCURRENCY', '4'))
+llm_preload_batch_max_prompts = int(os.environ.get('LLM_PRELOAD_BATCH_MAX_PROMPTS', '50'))
+billing_concurrency = int(os.environ.get('BILLING_CONCURRENCY', '16'))
+billing_default_shards = int(os.environ.get('BILLING_SHARDS', '4'))
+billing_user_scan_segments = int(os.environ.get('BILLING_USER_SCAN_SEGMENTS', '4'))
+schema_load_concurrency = int(os.environ.get('SCHEMA_LOAD_CONCURRENCY', '16'))
+# Tenant -> billing user lookups are cached per container; misses are cached for less time
+billing_user_cache_ttl_seconds = float(os.environ.get('BILLING_USER_CACHE_TTL_SECONDS', '300'))
+billing_user_cache_negative_ttl_seconds = float(os.environ.get('BILLING_USER_CACHE_NEGATIVE_TTL_SECONDS', '60'))
+# Spread per-request debits over this many counter items per user (0 = debit billing-admins directly)
+# (capped so reads fit one BatchGetItem and compaction fits one transaction)
+token_balance_shards = min(int(os.environ.get('TOKEN_BALANCE_SHARDS', '0')), 50)
+# 'local' limits each container on its own; 'dynamodb' also checks a bucket shared by all containers
+rate_limit_backend = os.environ.get('RATE_LIMIT_BACKEND', 'local').lower()
+# Buffered pageload debits: acknowledged once appended to the usage ledger, applied to
+# token_balance in one update per billing user by the scheduled rollup
+debit_buffer_enabled = os.environ.get('DEBIT_BUFFER', 'false').lower() == 'true'
+# Append-only usage ledger: debits become events, folded into balances by the scheduled rollup
+usage_ledger_enabled = os.environ.get('USAGE_LEDGER', 'false').lower() == 'true'
+llm_preload_cache_enabled = os.environ.get('LLM_PRELOAD_CACHE', 'true').lower() != 'false'
+llm_preload_cache_threshold = float(os.environ.get('LLM_PRELOAD_CACHE_THRESHOLD', '0.75'))
+llm_preload_cache_max_entries = int(os.environ.get('LLM_PRELOAD_CACHE_MAX_ENTRIES', '200'))
 print(f"Payment enforcement toggle: PAYMENT_ENABLED={os.environ.get('PAYMENT_ENABLED')}, resolved to: {payment_enforced}")
 
 # Initialize Stripe
@@ -45,6 +100,50 @@ class DecimalEncoder(json.JSONEncoder):
             return int(obj) if obj % 1 == 0 else float(obj)
         return super(DecimalEncoder, self).default(obj)
 
+# Upper bound for the per-run billing concurrency override
+BILLING_MAX_CONCURRENCY = 64
+
+BILLING_USER_CACHE_MAX_ENTRIES = 10000
+
+# Unrolled ledger events are spread over this many keys of the sparse PendingIndex
+USAGE_LEDGER_PENDING_SHARDS = 16
+# DynamoDB caps a transaction at 100 items
+MAX_TRANSACTION_ITEMS = 100
+
+# Billing runs: header item key, stop this long before the Lambda deadline, keep run records this long
+BILLING_RUN_HEADER = '#run'
+BILLING_RUN_TIME_MARGIN_MS = 30000
+BILLING_RUN_RETENTION_DAYS = 90
+BILLING_MAX_SHARDS = 64
+
+# Where handle_bill can read per-tenant storage from
+STORAGE_SOURCES = ['listing', 'counters', 'inventory']
+STORAGE_USAGE_REPORT_PREFIX = 'reports/storage-usage/'
+
+# Per-tenant token buckets per request type: rate is requests per second, burst the bucket size.
+# RATE_LIMITS (same JSON shape) replaces these; '{}' turns rate limiting off.
+DEFAULT_RATE_LIMITS = {
+    'llm': {'rate': 0.2, 'burst': 5},
+    'llm-preload': {'rate': 1, 'burst': 10},
+    'llm-preload-batch': {'rate': 0.05, 'burst': 2}
+}
+rate_limits = json.loads(os.environ['RATE_LIMITS']) if 'RATE_LIMITS' in os.environ else DEFAULT_RATE_LIMITS
+RATE_LIMIT_MAX_ATTEMPTS = 3
+
+# Parallel conditional puts used to claim the tenants in one registration request
+REGISTER_CLAIM_CONCURRENCY = 10
+
+# Request types that can be run as background jobs by passing "async": true
+ASYNC_JOB_TYPES = ['llm', 'llm-preload', 'llm-preload-batch']
+
+# Stripe webhook events processed by the event worker; everything else is acknowledged and dropped.
+# Token credits for purchases stay with the EventBridge -> SQS stripe-webhook-processor; these
+# handlers only link Stripe customers to billing admins, so an event reaching both paths is credited once.
+STRIPE_HANDLED_EVENT_TYPES = ['checkout.session.completed', 'customer.created']
+STRIPE_EVENT_RETENTION_DAYS = 30
+# Failed events are retried by redeliveries and the scheduled sweep until they have run this many times
+STRIPE_EVENT_MAX_ATTEMPTS = 5
+
 def lambda_handler(event, context):
     """Main Lambda handler for JSON Block Builder API"""
     try:
@@ -70,12 +169,25 @@ def lambda_handler(event, context):
         extension = body.get('extension')
         
         # Validate required fields
-        if not extension and request_type not in ['auth', 'oauth_token_exchange', 'register', 'bill']:
+        if not extension and request_type not in ['auth', 'oauth_token_exchange', 'register', 'bill', 'bill_shard', 'stripe_webhook', 'stripe_event_worker']:
             return create_response(400, {'error': 'extension is required'})
         
         if not request_type:
             return create_response(400, {'error': 'type is required'})
         
+        # Admission control: a noisy tenant gets a fast 429 instead of draining capacity shared by everyone
+        retry_after = check_rate_limit(extension, request_type)
+        if retry_after:
+            retry_after_seconds = max(1, math.ceil(retry_after))
+            return create_response(429, {
+                'error': f'Rate limit exceeded for {request_type}, retry after {retry_after_seconds}s',
+                'retry_after': retry_after_seconds
+            }, headers={'Retry-After': str(retry_after_seconds)})
+        
+        # Opt-in async mode for long-running LLM operations
+        if request_type in ASYNC_JOB_TYPES and body.get('async') is True:
+            return handle_async_job_submit(request_type, body)
+        
         # Route to appropriate handler
         if request_type == 'register':
             return handle_register(body)
@@ -87,6 +199,8 @@ def lambda_handler(event, context):
             return handle_llm(body)
         elif request_type == 'llm-preload':
             return handle_llm_preload(body)
+        elif request_type == 'llm-preload-batch':
+            return handle_llm_preload_batch(body)
         elif request_type == 'auth':
             return handle_auth(body)
         elif request_type == 'admin_delete':
@@ -98,13 +212,26 @@ def lambda_handler(event, context):
         elif request_type == 'oauth_token_exchange':
             return handle_oauth_token_exchange(body)
         elif request_type == 'bill':
-            return handle_bill(body)
+            return handle_bill(body, context)
+        elif request_type == 'bill_shard':
+            # Internal: invoked by a fan-out billing run, not exposed through API Gateway
+            return handle_bill_shard(body, context)
+        elif request_type == 'stripe_webhook':
+            # Signatures are computed over the exact bytes Stripe sent, so pass the unparsed body
+            return handle_stripe_webhook(raw_body, event)
+        elif request_type == 'stripe_event_worker':
+            # Internal: invoked asynchronously by stripe_webhook, not exposed through API Gateway
+            return handle_stripe_event_worker(body)
         elif request_type == 'create_account_link':
             return handle_create_account_link(body)
         elif request_type == 'check_account_status':
             return handle_check_account_status(body)
         elif request_type == 'debit_tokens':
             return handle_debit_tokens(body)
+        elif request_type == 'job_status':
+            return handle_job_status(body)
+        elif request_type == 'job_worker':
+            return handle_job_worker(body)
         else:
             return create_response(400, {'error': f'Invalid request type: {request_type}'})
             
@@ -114,6 +241,76 @@ def lambda_handler(event, context):
         print(f"Error: {str(e)}")
         return create_response(500, {'error': 'Internal server error'})
 
+_rate_limit_buckets = {}  # (tenant_id, request_type) -> (tokens, time.monotonic() of last refill)
+_rate_limit_lock = threading.Lock()
+
+def take_local_rate_limit_token(bucket_key, rate, burst):
+    """Take a token from this container's bucket; returns seconds until one is available, 0 if taken"""
+    now = time.monotonic()
+    with _rate_limit_lock:
+        tokens, last_refill = _rate_limit_buckets.get(bucket_key, (burst, now))
+        tokens = min(burst, tokens + (now - last_refill) * rate)
+        if tokens < 1:
+            _rate_limit_buckets[bucket_key] = (tokens, now)
+            return (1 - tokens) / rate
+        _rate_limit_buckets[bucket_key] = (tokens - 1, now)
+        return 0
+
+def take_shared_rate_limit_token(bucket_key, rate, burst):
+    """Take a token from the DynamoDB bucket all containers share; returns seconds until one is available, 0 if taken"""
+    bucket_id = '#'.join(bucket_key)
+    for _ in range(RATE_LIMIT_MAX_ATTEMPTS):
+        bucket = rate_limit_table.get_item(Key={'bucket_id': bucket_id}, ConsistentRead=True).get('Item')
+        now = time.time()
+        tokens = burst
+        if bucket:
+            tokens = min(burst, float(bucket['tokens']) + (now - float(bucket['updated_at'])) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        
+        item = {
+            'bucket_id': bucket_id,
+            'tokens': Decimal(str(round(tokens - 1, 6))),
+            'updated_at': Decimal(str(round(now, 6))),
+            'expires_at': int(now + burst / rate + 3600)
+        }
+        try:
+            # Optimistic concurrency: only write over the state we refilled from
+            if bucket:
+                rate_limit_table.put_item(
+                    Item=item,
+                    ConditionExpression='updated_at = :seen',
+                    ExpressionAttributeValues={':seen': bucket['updated_at']}
+                )
+            else:
+                rate_limit_table.put_item(Item=item, ConditionExpression='attribute_not_exists(bucket_id)')
+            return 0
+        except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            continue
+    
+    # Lost the race every time: the bucket is contended, so treat it as empty
+    return 1 / rate
+
+def check_rate_limit(tenant_id, request_type):
+    """Seconds the caller should wait before retrying, or 0 if the request may proceed"""
+    limit = rate_limits.get(request_type)
+    if not limit:
+        return 0
+    rate, burst = float(limit['rate']), float(limit['burst'])
+    bucket_key = (tenant_id or '', request_type)
+    
+    # The local bucket can only under-count, so a local refusal never needs the shared check
+    retry_after = take_local_rate_limit_token(bucket_key, rate, burst)
+    if retry_after or rate_limit_backend != 'dynamodb':
+        return retry_after
+    
+    try:
+        return take_shared_rate_limit_token(bucket_key, rate, burst)
+    except Exception as e:
+        # Fail open: a rate limiter outage shouldn't take the API down with it
+        print(f"Error checking shared rate limit for {bucket_key}: {str(e)}")
+        return 0
+
 def handle_authorizer(event):
     """Handle API Gateway authorizer requests"""
     try:
@@ -150,7 +347,7 @@ def generate_policy(principal_id, effect, resource):
         }
     }
 
-def create_response(status_code, body):
+def create_response(status_code, body, headers=None):
     """Create a standardized API Gateway response with full CORS headers"""
     response = {
         'statusCode': status_code,
@@ -162,6 +359,8 @@ def create_response(status_code, body):
         },
         'body': json.dumps(body, cls=DecimalEncoder)
     }
+    if headers:
+        response['headers'].update(headers)
     
     # For error responses, make sure the status code is in the error message
     # so API Gateway can map it correctly
@@ -267,6 +466,7 @@ def handle_register(body):
     successful_tenants = []
     failed_tenants = []
     
+    tenants_to_claim = []
     for tenant_name in tenants:
         if not tenant_name or not isinstance(tenant_name, str):
             failed_tenants.append(tenant_name)
@@ -278,8 +478,12 @@ def handle_register(body):
             failed_tenants.append(tenant_name)
             continue
         
+        if tenant_name not in tenants_to_claim:
+            tenants_to_claim.append(tenant_name)
+    
+    def claim_tenant(tenant_name):
+        """Create the tenant mapping unless the name is taken; True if it now belongs to this user"""
         try:
-            # Try to create tenant mapping
             billing_user_from_tenant_table.put_item(
                 Item={
                     'tenant_id': tenant_name,
@@ -289,31 +493,47 @@ def handle_register(body):
                 },
                 ConditionExpression='attribute_not_exists(tenant_id)'
             )
-            successful_tenants.append(tenant_name)
             print(f"Successfully registered tenant: {tenant_name} for {email}")
-            
+            return True
         except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
             # Tenant already taken
-            failed_tenants.append(tenant_name)
             print(f"Tenant {tenant_name} already taken")
+            return False
         except Exception as e:
             print(f"Error registering tenant {tenant_name}: {str(e)}")
-            failed_tenants.append(tenant_name)
+            return False
+        finally:
+            # A mapping may exist now whatever happened; don't keep serving a cached miss for it
+            invalidate_billing_user_cache(tenant_name)
     
-    # Query the user GSI to get final tenant list
+    # Claims are independent conditional puts, so they run in parallel and one taken name never blocks the rest
+    if tenants_to_claim:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(tenants_to_claim), REGISTER_CLAIM_CONCURRENCY)) as executor:
+            claimed = list(executor.map(claim_tenant, tenants_to_claim))
+        for tenant_name, was_claimed in zip(tenants_to_claim, claimed):
+            (successful_tenants if was_claimed else failed_tenants).append(tenant_name)
+    
+    # Query the user GSI for tenants from earlier registrations
+    all_user_tenants = []
     try:
-        response = billing_user_from_tenant_table.query(
-            IndexName='UserEmailIndex',
-            KeyConditionExpression='user_email = :email',
-            ExpressionAttributeValues={':email': email}
-        )
-        
-        all_user_tenants = [item['tenant_id'] for item in response['Items']]
-        print(f"User {email} now has tenants: {all_user_tenants}")
-        
+        query_kwargs = {
+            'IndexName': 'UserEmailIndex',
+            'KeyConditionExpression': 'user_email = :email',
+            'ExpressionAttributeValues': {':email': email},
+            'ProjectionExpression': 'tenant_id'
+        }
+        while True:
+            response = billing_user_from_tenant_table.query(**query_kwargs)
+            all_user_tenants.extend(item['tenant_id'] for item in response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
     except Exception as e:
         print(f"Error querying user tenants: {str(e)}")
-        all_user_tenants = successful_tenants  # Fallback to what we know succeeded
+    
+    # GSI reads are eventually consistent and can miss the claims just written, so merge those in
+    all_user_tenants.extend(tenant_name for tenant_name in successful_tenants if tenant_name not in all_user_tenants)
+    print(f"User {email} now has tenants: {all_user_tenants}")
     
     # Return success response
     return create_response(200, {
@@ -340,15 +560,15 @@ def handle_delete(body):
     
     for filename in schema_files:
         try:
-            s3.delete_object(
-                Bucket=bucket_name,
-                Key=f"schemas/{body['extension']}/{filename}"
-            )
+            delete_tenant_object(body['extension'], f"schemas/{body['extension']}/{filename}")
             deleted_files.append(filename)
         except Exception as e:
             print(f"Error deleting {filename}: {str(e)}")
             failed_files.append(filename)
     
+    if deleted_files:
+        update_ref_graph(body['extension'])
+    
     response_body = {
         'message': f'Deleted {len(deleted_files)} schema files',
         'deleted_files': deleted_files
@@ -410,10 +630,10 @@ def handle_json(body, event=None):
         file_contents = ""
         for key, value in properties.items():
             file_contents += f"{key}={value}\n"
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=f"schemas/{body['extension']}/tenant.properties",
-            Body=file_contents
+        put_tenant_object(
+            body['extension'],
+            f"schemas/{body['extension']}/tenant.properties",
+            file_contents
         )
     
     # Handle loose endpoints if provided
@@ -421,10 +641,10 @@ def handle_json(body, event=None):
     if endpoints:
         # Save loose endpoints as plain text file
         endpoints_content = "\n".join(endpoints)
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=f"schemas/{body['extension']}/endpoints.properties",
-            Body=endpoints_content
+        put_tenant_object(
+            body['extension'],
+            f"schemas/{body['extension']}/endpoints.properties",
+            endpoints_content
         )
         uploaded_schemas.append("endpoints.properties")
     
@@ -441,10 +661,10 @@ def handle_json(body, event=None):
                 filename = title if title.endswith('.json') else f"{title}.json"
             
             # Upload to S3
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=f"schemas/{body['extension']}/{filename}",
-                Body=json.dumps(schema_data, indent=2),
+            put_tenant_object(
+                body['extension'],
+                f"schemas/{body['extension']}/{filename}",
+                json.dumps(schema_data, indent=2)
             )
             
             uploaded_schemas.append(filename)
@@ -494,6 +714,8 @@ def handle_json(body, event=None):
                     print(f"Tenant {billing_admin_data['tenant_id']} mapping already exists for {billing_admin_data['user_email']}")
                 except Exception as e:
                     print(f"Error adding tenant mapping: {str(e)}")
+                finally:
+                    invalidate_billing_user_cache(billing_admin_data['tenant_id'])
                 
                 # Update last activity
                 billing_table.update_item(
@@ -537,9 +759,17 @@ def handle_json(body, event=None):
     if failed_schemas:
         response_body['failed_schemas'] = failed_schemas
     
+    # Keep the $ref graph index current and report refs that point at no schema
+    if any(filename.endswith('.json') for filename in uploaded_schemas):
+        ref_graph = update_ref_graph(body['extension'])
+        if ref_graph:
+            dangling_refs = {f: ref_graph['dangling'][f] for f in uploaded_schemas if f in ref_graph['dangling']}
+            if dangling_refs:
+                response_body['dangling_refs'] = dangling_refs
+    
     return create_response(200, response_body)
 
-def handle_llm(body):
+def handle_llm(body, progress_callback=None):
     """Handle LLM schema generation using OpenAI"""
     schema_definitions = body.get('schema', [])
     
@@ -549,26 +779,42 @@ def handle_llm(body):
     if not openai_api_key:
         return create_response(500, {'error': 'OpenAI API key not configured'})
     
+    if body.get('batch') is True and len(schema_definitions) > SCHEMA_BATCH_MAX_DESCRIPTIONS:
+        return create_response(400, {
+            'error': f'At most {SCHEMA_BATCH_MAX_DESCRIPTIONS} descriptions fit in one batch; split the request or omit batch'
+        })
+    
     try:
         # Debit tokens for LLM schema generation (10 tokens) - always bill when billing user found
         billing_user_email = get_billing_user_for_tenant(body['extension'])
         if billing_user_email:
-            debit_success = debit_tokens_from_user(billing_user_email, 10, 'llm-generate')
+            debit_success = debit_tokens_from_user(billing_user_email, 10, 'llm-generate', tenant_id=body['extension'])
             if not debit_success:
                 print(f"Warning: Failed to debit tokens for llm-generate, but allowing operation to continue")
         
         # Convert plain English descriptions to JSON schemas using OpenAI
         generated_schemas = []
         failed_schemas = []
+        dangling_refs = {}
         
-        for i, description in enumerate(schema_definitions):
-            try:
-                # Generate JSON schema from plain English description
-                json_schema = generate_schema_from_description(description)
-                generated_schemas.append(json_schema)
-            except Exception as e:
-                print(f"Error generating schema for description {i}: {str(e)}")
-                failed_schemas.append(f"description_{i}")
+        if body.get('batch') is True:
+            # One round trip for all descriptions so cross-schema $refs stay consistent
+            generated_schemas, failed_schemas, dangling_refs = generate_schema_batch(
+                body['extension'], schema_definitions, progress_callback
+            )
+        else:
+            for i, description in enumerate(schema_definitions):
+                try:
+                    # Generate JSON schema from plain English description
+                    json_schema = generate_schema_from_description(description)
+                    generated_schemas.append(json_schema)
+                    if progress_callback:
+                        progress_callback({'event': 'schema_generated', 'index': i, 'total': len(schema_definitions)})
+                except Exception as e:
+                    print(f"Error generating schema for description {i}: {str(e)}")
+                    failed_schemas.append(f"description_{i}")
+                    if progress_callback:
+                        progress_callback({'event': 'schema_failed', 'index': i, 'total': len(schema_definitions)})
         
         # Now process the generated schemas the same way as the json endpoint
         uploaded_schemas = []
@@ -579,10 +825,10 @@ def handle_llm(body):
             file_contents = ""
             for key, value in properties.items():
                 file_contents += f"{key}={value}\n"
-            s3.put_object(
-                Bucket=bucket_name,
-                Key=f"schemas/{body['extension']}/tenant.properties",
-                Body=file_contents
+            put_tenant_object(
+                body['extension'],
+                f"schemas/{body['extension']}/tenant.properties",
+                file_contents
             )
         
         # Upload generated schemas to S3
@@ -599,10 +845,10 @@ def handle_llm(body):
                     filename = title if title.endswith('.json') else f"{title}.json"
                 
                 # Upload to S3
-                s3.put_object(
-                    Bucket=bucket_name,
-                    Key=f"schemas/{body['extension']}/{filename}",
-                    Body=json.dumps(schema_data, indent=2),
+                put_tenant_object(
+                    body['extension'],
+                    f"schemas/{body['extension']}/{filename}",
+                    json.dumps(schema_data, indent=2)
                 )
                 
                 uploaded_schemas.append(filename)
@@ -624,13 +870,147 @@ def handle_llm(body):
         if failed_schemas:
             response_body['failed_schemas'] = failed_schemas
         
+        # Keep the $ref graph index current and report refs that point at no schema
+        if uploaded_schemas:
+            ref_graph = update_ref_graph(body['extension'])
+            if ref_graph:
+                for filename in uploaded_schemas:
+                    if filename in ref_graph['dangling']:
+                        dangling_refs.setdefault(filename, ref_graph['dangling'][filename])
+        if dangling_refs:
+            response_body['dangling_refs'] = dangling_refs
+        
         return create_response(200, response_body)
         
     except Exception as e:
         print(f"Error in LLM processing: {str(e)}")
         return create_response(500, {'error': 'Failed to process LLM request'})
 
-def handle_llm_preload(body):
+# Near-duplicate llm-preload result cache. Prompts are normalized into word shingles and
+# fingerprinted with MinHash; results are scoped to a hash of the tenant's schemas so a
+# schema change never serves an object validated against an older version.
+# Only articles, request filler and naming words: prepositions and conjunctions change what is being asked for
+PRELOAD_CACHE_STOPWORDS = {
+    'a', 'an', 'the', 'please', 'create', 'make', 'generate', 'give', 'me', 'some', 'new',
+    'named', 'called', 'who', 'that', 'is'
+}
+PRELOAD_CACHE_NUM_HASHES = 64
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = random.Random(20240601)
+_MINHASH_PARAMS = [
+    (_minhash_random.randrange(1, _MINHASH_PRIME), _minhash_random.randrange(0, _MINHASH_PRIME))
+    for _ in range(PRELOAD_CACHE_NUM_HASHES)
+]
+_preload_cache = {}
+_preload_cache_lock = threading.Lock()
+
+def get_schema_version(schemas):
+    """Stable fingerprint of a tenant's schema set"""
+    canonical = json.dumps(
+        sorted(([schema_info['filename'], schema_info['schema']] for schema_info in schemas), key=lambda item: item[0]),
+        sort_keys=True,
+        cls=DecimalEncoder
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+def get_prompt_words(prompt):
+    """Split a prompt into its words, punctuation removed and case kept"""
+    return ''.join(c if c.isalnum() else ' ' for c in prompt).split()
+
+def get_prompt_shingles(prompt):
+    """Normalize a prompt to lowercase word tokens without filler words and return its 1- and 2-word shingles"""
+    tokens = [word.lower() for word in get_prompt_words(prompt)]
+    tokens = [token for token in tokens if token not in PRELOAD_CACHE_STOPWORDS]
+    return set(tokens) | {f"{first} {second}" for first, second in zip(tokens, tokens[1:])}
+
+def get_prompt_specifics(prompt):
+    """Numbers and capitalized names (past the first word) in a prompt, lowercased"""
+    words = get_prompt_words(prompt)
+    return {
+        word.lower() for index, word in enumerate(words)
+        if any(c.isdigit() for c in word) or (index > 0 and word[0].isupper())
+    }
+
+def prompts_share_specifics(prompt, other_prompt):
+    """Whether each prompt's numbers and names also appear in the other.
+    
+    A long prompt differing only in "3 passengers" vs "4 passengers" still scores high on
+    shingles, but the cached object would carry the wrong value.
+    """
+    words = {word.lower() for word in get_prompt_words(prompt)}
+    other_words = {word.lower() for word in get_prompt_words(other_prompt)}
+    return get_prompt_specifics(prompt) <= other_words and get_prompt_specifics(other_prompt) <= words
+
+def get_minhash_signature(shingles):
+    """MinHash signature of a shingle set"""
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big') for shingle in shingles]
+    return [min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS]
+
+def get_preload_cache_entries(tenant_id, schema_version):
+    """Entries cached for a tenant's schema version, loading them from S3 on first use in this container"""
+    cache_key = (tenant_id, schema_version)
+    with _preload_cache_lock:
+        if cache_key in _preload_cache:
+            return _preload_cache[cache_key]
+    
+    entries = []
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=f"cache/llm-preload/{tenant_id}/{schema_version}.json")
+        entries = json.loads(response['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        pass
+    except Exception as e:
+        print(f"Error loading llm-preload cache for tenant {tenant_id}: {str(e)}")
+    
+    with _preload_cache_lock:
+        return _preload_cache.setdefault(cache_key, entries)
+
+def lookup_preload_cache(tenant_id, schema_version, prompt):
+    """Return (entry, similarity) for the most similar cached prompt at or above the threshold, else (None, 0)"""
+    shingles = get_prompt_shingles(prompt)
+    if not shingles:
+        return None, 0
+    signature = get_minhash_signature(shingles)
+    
+    best_entry, best_similarity = None, 0
+    for entry in get_preload_cache_entries(tenant_id, schema_version):
+        matches = sum(1 for mine, theirs in zip(signature, entry['signature']) if mine == theirs)
+        similarity = matches / PRELOAD_CACHE_NUM_HASHES
+        if similarity > best_similarity and prompts_share_specifics(prompt, entry['prompt']):
+            best_entry, best_similarity = entry, similarity
+    
+    if best_similarity >= llm_preload_cache_threshold:
+        return best_entry, best_similarity
+    return None, best_similarity
+
+def store_preload_cache(tenant_id, schema_version, prompt, result):
+    """Remember a validated llm-preload result for near-duplicate prompts"""
+    shingles = get_prompt_shingles(prompt)
+    if not shingles:
+        return
+    entries = get_preload_cache_entries(tenant_id, schema_version)
+    with _preload_cache_lock:
+        entries.append({
+            'signature': get_minhash_signature(shingles),
+            'prompt': prompt,
+            'json_object': result['json_object'],
+            'root_schema': result['root_schema'],
+            'cached_at': datetime.utcnow().isoformat()
+        })
+        # Oldest entries go first once the per-version cap is hit
+        del entries[:-llm_preload_cache_max_entries]
+        snapshot = json.dumps(entries, cls=DecimalEncoder)
+    try:
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=f"cache/llm-preload/{tenant_id}/{schema_version}.json",
+            Body=snapshot,
+            ContentType='application/json'
+        )
+    except Exception as e:
+        print(f"Error saving llm-preload cache for tenant {tenant_id}: {str(e)}")
+
+def handle_llm_preload(body, progress_callback=None, stream_tokens=False):
     """Handle LLM preload - generate JSON object that complies with existing schemas"""
     # Extract the actual request data from the API Gateway wrapper
     request_data = body.get('body', body)
@@ -653,12 +1033,20 @@ def handle_llm_preload(body):
         # Debit tokens for LLM preload operation (10 tokens) - always bill when billing user found
         billing_user_email = get_billing_user_for_tenant(tenant_id)
         if billing_user_email:
-            debit_success = debit_tokens_from_user(billing_user_email, 10, 'llm-preload')
+            debit_success = debit_tokens_from_user(billing_user_email, 10, 'llm-preload', tenant_id=tenant_id)
             if not debit_success:
                 print(f"Warning: Failed to debit tokens for llm-preload, but allowing operation to continue")
         
-        # Load all schemas for the tenant from S3
-        schemas = load_tenant_schemas(tenant_id)
+        # Load all schemas for the tenant from S3, or only a requested root and its $ref closure
+        only_filenames = None
+        root_schema = request_data.get('root_schema')
+        if root_schema:
+            ref_graph = load_ref_graph(tenant_id)
+            closure = get_schema_closure(ref_graph, root_schema) if ref_graph else []
+            if closure:
+                only_filenames = set(closure)
+                print(f"Restricting preload to {root_schema} and its $ref closure: {closure}")
+        schemas = load_tenant_schemas(tenant_id, only_filenames)
         
         print(f"Found {len(schemas)} schemas for tenant {tenant_id}")
         for schema in schemas:
@@ -667,15 +1055,37 @@ def handle_llm_preload(body):
         if not schemas:
             return create_response(404, {'error': 'No schemas found for tenant'})
         
+        # Serve near-duplicate prompts from the result cache for this schema version
+        use_cache = llm_preload_cache_enabled and request_data.get('no_cache') is not True
+        schema_version = get_schema_version(schemas)
+        if use_cache:
+            cached_entry, similarity = lookup_preload_cache(tenant_id, schema_version, user_prompt)
+            if cached_entry:
+                print(f"LLM preload cache hit for tenant {tenant_id} (similarity {similarity:.2f}): {cached_entry['prompt']}")
+                return create_response(200, {
+                    'message': 'Returned cached compliant JSON object',
+                    'json_object': cached_entry['json_object'],
+                    'root_schema': cached_entry['root_schema'],
+                    'attempts': 0,
+                    'cached': True,
+                    'similarity': round(similarity, 3)
+                })
+        
         # Generate JSON object that complies with one of the schemas
-        result = generate_compliant_json_object(schemas, user_prompt, tenant_id)
+        result = generate_compliant_json_object(
+            schemas, user_prompt, tenant_id, progress_callback, stream_tokens,
+            preload_context=get_preload_context(tenant_id, schema_version, schemas)
+        )
         
         if result['success']:
+            if use_cache:
+                store_preload_cache(tenant_id, schema_version, user_prompt, result)
             return create_response(200, {
                 'message': 'Successfully generated compliant JSON object',
                 'json_object': result['json_object'],
                 'root_schema': result['root_schema'],
-                'attempts': result['attempts']
+                'attempts': result['attempts'],
+                'cached': False
             })
         else:
             return create_response(400, {
@@ -688,67 +1098,218 @@ def handle_llm_preload(body):
         print(f"Error in LLM preload processing: {str(e)}")
         return create_response(500, {'error': 'Failed to process LLM preload request'})
 
-def load_tenant_schemas(tenant_id):
-    """Load all schemas for a tenant from S3"""
+def handle_llm_preload_batch(body, progress_callback=None):
+    """Handle batch LLM preload - generate one compliant JSON object per prompt.
+    
+    Schemas, the system prompt and compiled validators are prepared once and shared by every
+    generation, generations run concurrently, and the billing user is debited once for the batch.
+    """
+    tenant_id = body.get('extension')
+    prompts = body.get('prompts', [])
+    
+    if not tenant_id:
+        return create_response(400, {'error': 'extension is required for llm-preload-batch operation'})
+    
+    if not isinstance(prompts, list) or not prompts or not all(isinstance(p, str) and p.strip() for p in prompts):
+        return create_response(400, {'error': 'prompts must be a non-empty list of prompt strings'})
+    
+    if len(prompts) > llm_preload_batch_max_prompts:
+        return create_response(400, {'error': f'At most {llm_preload_batch_max_prompts} prompts are allowed per batch'})
+    
+    if not openai_api_key:
+        return create_response(500, {'error': 'OpenAI API key not configured'})
+    
+    try:
+        # Debit tokens for the whole batch at once (10 tokens per prompt, same as llm-preload)
+        billing_user_email = get_billing_user_for_tenant(tenant_id)
+        if billing_user_email:
+            debit_success = debit_tokens_from_user(billing_user_email, 10 * len(prompts), 'llm-preload-batch', tenant_id=tenant_id)
+            if not debit_success:
+                print(f"Warning: Failed to debit tokens for llm-preload-batch, but allowing operation to continue")
+        
+        schemas = load_tenant_schemas(tenant_id)
+        print(f"Found {len(schemas)} schemas for tenant {tenant_id}, generating {len(prompts)} objects")
+        
+        if not schemas:
+            return create_response(404, {'error': 'No schemas found for tenant'})
+        
+        use_cache = llm_preload_cache_enabled and body.get('no_cache') is not True
+        schema_version = get_schema_version(schemas)
+        preload_context = get_preload_context(tenant_id, schema_version, schemas)
+        
+        def generate(index):
+            try:
+                cached_entry = None
+                if use_cache:
+                    cached_entry, similarity = lookup_preload_cache(tenant_id, schema_version, prompts[index])
+                if cached_entry:
+                    result = {
+                        'success': True,
+                        'json_object': cached_entry['json_object'],
+                        'root_schema': cached_entry['root_schema'],
+                        'attempts': 0,
+                        'cached': True
+                    }
+                else:
+                    result = generate_compliant_json_object(schemas, prompts[index], tenant_id, preload_context=preload_context)
+                    if use_cache and result['success']:
+                        store_preload_cache(tenant_id, schema_version, prompts[index], result)
+            except Exception as e:
+                print(f"Error generating object for prompt {index}: {str(e)}")
+                result = {'success': False, 'errors': ['Failed to generate JSON object'], 'attempts': 0}
+            if progress_callback:
+                progress_callback({'event': 'prompt_completed', 'index': index, 'success': result['success']})
+            return {'index': index, **result}
+        
+        max_workers = max(1, min(llm_preload_batch_concurrency, len(prompts)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(generate, range(len(prompts))))
+        
+        succeeded = sum(1 for result in results if result['success'])
+        return create_response(200, {
+            'message': f'Generated {succeeded} of {len(prompts)} compliant JSON objects',
+            'results': results,
+            'succeeded': succeeded,
+            'failed': len(prompts) - succeeded
+        })
+        
+    except Exception as e:
+        print(f"Error in LLM preload batch processing: {str(e)}")
+        return create_response(500, {'error': 'Failed to process LLM preload batch request'})
+
+# Parsed schema bodies keyed by S3 key, reused for as long as the object's ETag is unchanged
+_schema_object_cache = {}
+_schema_object_cache_lock = threading.Lock()
+
+def load_schema_object(key, etag, gzipped=False):
+    """Return the parsed JSON body of a schema object, downloading it only if its ETag changed"""
+    with _schema_object_cache_lock:
+        cached = _schema_object_cache.get(key)
+    if cached and cached[0] == etag:
+        return cached[1]
+    
+    obj_response = s3.get_object(Bucket=bucket_name, Key=key)
+    content = obj_response['Body'].read()
+    if gzipped:
+        content = gzip.decompress(content)
+    schema_data = json.loads(content.decode('utf-8'))
+    with _schema_object_cache_lock:
+        _schema_object_cache[key] = (obj_response.get('ETag', etag), schema_data)
+    return schema_data
+
+def load_tenant_schema_bundle(tenant_id, listed_objects):
+    """Return {schema name: schema} from the server's gzip bundle, or None if no bundle is current.
+    
+    server.js writes cache/schemas/{tenant}/cache_{hash}.gz, but its hash includes the time of the
+    request, so it can't be recomputed here. A bundle counts as current when it holds exactly the
+    listed .json schemas and was written after the newest listed schema or properties file.
+    """
+    bundle_prefix = f"cache/schemas/{tenant_id}/cache_"
+    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=bundle_prefix)
+    bundles = [obj for obj in response.get('Contents', []) if obj['Key'].endswith('.gz')]
+    if not bundles:
+        return None
+    
+    bundle = max(bundles, key=lambda obj: obj['LastModified'])
+    with _schema_object_cache_lock:
+        for key in [key for key in _schema_object_cache if key.startswith(bundle_prefix) and key != bundle['Key']]:
+            del _schema_object_cache[key]
+    newest_listed = max(
+        (obj['LastModified'] for obj in listed_objects if obj['Key'].endswith(('.json', '.properties'))),
+        default=None
+    )
+    # S3 timestamps have one-second resolution, so a bundle from the same second might predate an upload
+    if newest_listed and bundle['LastModified'] <= newest_listed:
+        print(f"Schema bundle {bundle['Key']} is older than the tenant's schemas")
+        return None
+    
+    bundle_data = load_schema_object(bundle['Key'], bundle.get('ETag'), gzipped=True)
+    bundle_schemas = bundle_data.get('schemas') or {}
+    listed_names = {obj['Key'].split('/')[-1][:-len('.json')] for obj in listed_objects if obj['Key'].endswith('.json')}
+    if set(bundle_schemas) != listed_names:
+        print(f"Schema bundle {bundle['Key']} does not match the current schema listing")
+        return None
+    
+    return bundle_schemas
+
+def load_tenant_schemas(tenant_id, only_filenames=None):
+    """Load all schemas for a tenant from S3, or just the given filenames"""
     schemas = []
+    prefix = f"schemas/{tenant_id}/"
     
     try:
-        print(f"Listing objects in S3 bucket: {bucket_name}")
-        print(f"Prefix: schemas/{tenant_id}/")
+        print(f"Listing schemas in s3://{bucket_name}/{prefix}")
         
-        # List all objects in the tenant's schema folder
-        response = s3.list_objects_v2(
-            Bucket=bucket_name,
-            Prefix=f"schemas/{tenant_id}/"
-        )
+        # List every page of the tenant's schema folder
+        listed_objects = []
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            listed_objects.extend(page.get('Contents', []))
+        # Only process JSON files
+        schema_objects = [obj for obj in listed_objects if obj['Key'].endswith('.json')]
+        if only_filenames is not None:
+            schema_objects = [obj for obj in schema_objects if obj['Key'].split('/')[-1] in only_filenames]
+        
+        # Forget cached bodies for schemas that no longer exist
+        listed_keys = {obj['Key'] for obj in listed_objects}
+        with _schema_object_cache_lock:
+            for key in [key for key in _schema_object_cache if key.startswith(prefix) and key not in listed_keys]:
+                del _schema_object_cache[key]
+        
+        if not schema_objects:
+            print("No schema files found for tenant")
+            return schemas
         
-        print(f"S3 response: {response}")
+        # Prefer the prebuilt gzip bundle: one GET instead of one per schema
+        try:
+            bundle_schemas = load_tenant_schema_bundle(tenant_id, listed_objects)
+        except Exception as e:
+            print(f"Error reading schema bundle for tenant {tenant_id}: {str(e)}")
+            bundle_schemas = None
         
-        if 'Contents' not in response:
-            print("No Contents found in S3 response")
+        if bundle_schemas is not None:
+            for obj in schema_objects:
+                filename = obj['Key'].split('/')[-1]
+                schema_data = bundle_schemas[filename[:-len('.json')]]
+                schemas.append({
+                    'id': schema_data.get('$id', filename),
+                    'schema': schema_data,
+                    'filename': filename
+                })
+            print(f"Loaded {len(schemas)} schemas for tenant {tenant_id} from bundle")
             return schemas
         
-        for obj in response['Contents']:
-            key = obj['Key']
-            # Skip tenant.properties file
-            if key.endswith('tenant.properties'):
+        def load(obj):
+            try:
+                return load_schema_object(obj['Key'], obj.get('ETag'))
+            except Exception as e:
+                print(f"Error loading schema {obj['Key']}: {str(e)}")
+                return None
+        
+        # Fetch changed schema bodies concurrently
+        max_workers = max(1, min(schema_load_concurrency, len(schema_objects)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            loaded = list(executor.map(load, schema_objects))
+        
+        for obj, schema_data in zip(schema_objects, loaded):
+            if schema_data is None:
                 continue
-                
-            # Only process JSON files
-            if key.endswith('.json'):
-                try:
-                    # Get the object content
-                    obj_response = s3.get_object(Bucket=bucket_name, Key=key)
-                    schema_content = obj_response['Body'].read().decode('utf-8')
-                    schema_data = json.loads(schema_content)
-                    
-                    # Extract schema ID for reference
-                    schema_id = schema_data.get('$id', key.split('/')[-1])
-                    schemas.append({
-                        'id': schema_id,
-                        'schema': schema_data,
-                        'filename': key.split('/')[-1]
-                    })
-                    
-                except Exception as e:
-                    print(f"Error loading schema {key}: {str(e)}")
-                    continue
+            filename = obj['Key'].split('/')[-1]
+            # Extract schema ID for reference
+            schema_id = schema_data.get('$id', filename)
+            schemas.append({
+                'id': schema_id,
+                'schema': schema_data,
+                'filename': filename
+            })
                     
     except Exception as e:
         print(f"Error listing schemas for tenant {tenant_id}: {str(e)}")
     
     return schemas
 
-def generate_compliant_json_object(schemas, user_prompt, tenant_id):
-    """Generate a JSON object that complies with one of the provided schemas"""
-    try:
-        import jsonschema
-        from jsonschema import validate, ValidationError, RefResolver
-        jsonschema_available = True
-    except ImportError:
-        print("Warning: jsonschema module not available, using basic validation")
-        jsonschema_available = False
-    
+def build_preload_system_prompt(schemas):
+    """Build the llm-preload system prompt describing every available schema"""
     # Create context string with all schemas
     schema_context = "Available schemas for this tenant:\n\n"
     for schema_info in schemas:
@@ -850,7 +1411,100 @@ A sample return complying with the previous schema would be:
 
 Be sure to distinctly include both detected_schema and json_object (compliant) in your response.
 """
+    return system_prompt
+
+def normalize_schema_name(name):
+    """Canonical lookup key for a schema name: case-folded, no .json extension, letters and digits only"""
+    if not isinstance(name, str):
+        return ''
+    name = name.strip().casefold()
+    if name.endswith('.json'):
+        name = name[:-len('.json')]
+    return ''.join(c for c in name if c.isalnum())
+
+def build_schema_lookup(schemas):
+    """Map every $id, filename and title variant of each schema to its schema info"""
+    lookup = {}
+    # Filenames first, then $ids (whole and last path segment), then titles,
+    # so a title can never shadow a real schema name
+    name_getters = [
+        lambda schema_info: schema_info['filename'],
+        lambda schema_info: schema_info['id'],
+        lambda schema_info: get_ref_target(schema_info['id']),
+        lambda schema_info: schema_info['schema'].get('title')
+    ]
+    for get_name in name_getters:
+        for schema_info in schemas:
+            key = normalize_schema_name(get_name(schema_info))
+            if key:
+                lookup.setdefault(key, schema_info)
+    return lookup
 
+def prepare_preload_context(schemas):
+    """Precompute what every llm-preload generation against the same schemas can share"""
+    return {
+        'system_prompt': build_preload_system_prompt(schemas),
+        'schema_store': {schema_info['id']: schema_info['schema'] for schema_info in schemas},
+        'lookup': build_schema_lookup(schemas),
+        'validators': {},
+        'lock': threading.Lock()
+    }
+
+# Preload contexts (prompt, lookup table, compiled validators) per tenant schema version
+_preload_contexts = {}
+_preload_contexts_lock = threading.Lock()
+PRELOAD_CONTEXT_CACHE_SIZE = 32
+
+def get_preload_context(tenant_id, schema_version, schemas):
+    """Return the preload context for a tenant's schema version, building it once per container"""
+    cache_key = (tenant_id, schema_version)
+    with _preload_contexts_lock:
+        preload_context = _preload_contexts.get(cache_key)
+    if preload_context is None:
+        preload_context = prepare_preload_context(schemas)
+        with _preload_contexts_lock:
+            preload_context = _preload_contexts.setdefault(cache_key, preload_context)
+            # Dicts keep insertion order, so the first key is the oldest context
+            while len(_preload_contexts) > PRELOAD_CONTEXT_CACHE_SIZE:
+                del _preload_contexts[next(iter(_preload_contexts))]
+    return preload_context
+
+def get_schema_validator(preload_context, schema_id, schema):
+    """Return a compiled validator for a schema, building it once per preload context"""
+    from jsonschema import RefResolver
+    from jsonschema.validators import validator_for
+    
+    with preload_context['lock']:
+        validator = preload_context['validators'].get(schema_id)
+        if validator is None:
+            validator_cls = validator_for(schema)
+            validator_cls.check_schema(schema)
+            # Create a resolver with the schema store for resolving $ref references
+            resolver = RefResolver(base_uri="", referrer=schema, store=preload_context['schema_store'])
+            validator = validator_cls(schema, resolver=resolver)
+            preload_context['validators'][schema_id] = validator
+            print(f"Compiled validator for schema: {schema_id}")
+    return validator
+
+def generate_compliant_json_object(schemas, user_prompt, tenant_id, progress_callback=None, stream_tokens=False, preload_context=None):
+    """Generate a JSON object that complies with one of the provided schemas.
+    
+    progress_callback, if given, is called with a dict for each attempt and validation outcome.
+    With stream_tokens it also receives a 'token' event for every chunk OpenAI streams back.
+    preload_context (from prepare_preload_context) lets several generations share one prompt and validator set.
+    """
+    try:
+        import jsonschema
+        from jsonschema import ValidationError
+        jsonschema_available = True
+    except ImportError:
+        print("Warning: jsonschema module not available, using basic validation")
+        jsonschema_available = False
+    
+    if preload_context is None:
+        preload_context = prepare_preload_context(schemas)
+    system_prompt = preload_context['system_prompt']
+    
     user_prompt_text = f"User request: {user_prompt}"
     
     max_attempts = 3
@@ -858,10 +1512,19 @@ Be sure to distinctly include both detected_schema and json_object (compliant) i
     
     while attempts < max_attempts:
         attempts += 1
+        if progress_callback:
+            progress_callback({'event': 'attempt', 'attempt': attempts, 'max_attempts': max_attempts})
         
         try:
             # Generate JSON object using OpenAI
-            generated_response = call_openai_api(system_prompt, user_prompt_text)
+            if stream_tokens and progress_callback:
+                generated_response = stream_openai_api(
+                    system_prompt,
+                    user_prompt_text,
+                    lambda delta: progress_callback({'event': 'token', 'attempt': attempts, 'delta': delta})
+                )
+            else:
+                generated_response = call_openai_api(system_prompt, user_prompt_text)
             print(f"LLM Response on attempt {attempts}: {generated_response}")
             
             # Parse the response
@@ -875,44 +1538,28 @@ Be sure to distinctly include both detected_schema and json_object (compliant) i
             if not detected_schema_id or not json_object:
                 raise Exception("Invalid response format from OpenAI")
             
-            # Normalize schema ID by adding .json extension if missing
-            if not detected_schema_id.endswith(".json"):
-                detected_schema_id = detected_schema_id + ".json"
-                print(f"Normalized schema ID to: {detected_schema_id}")
-            
-            # Find the matching schema
-            matching_schema = None
-            print(f"Looking for schema with ID: '{detected_schema_id}'")
-            for schema_info in schemas:
-                print(f"Checking schema - ID: '{schema_info['id']}', Filename: '{schema_info['filename']}'")
-                if schema_info['id'] == detected_schema_id or schema_info['filename'] == detected_schema_id:
-                    matching_schema = schema_info['schema']
-                    print(f"Found matching schema: {schema_info['id']}")
-                    break
-            
-            if not matching_schema:
+            # Find the matching schema by $id, filename or title, ignoring case and the .json extension
+            schema_info = preload_context['lookup'].get(normalize_schema_name(detected_schema_id))
+            if not schema_info:
                 available_schemas = [f"ID: '{s['id']}', Filename: '{s['filename']}'" for s in schemas]
                 raise Exception(f"Schema '{detected_schema_id}' not found in available schemas. Available: {available_schemas}")
             
+            matching_schema = schema_info['schema']
+            detected_schema_id = schema_info['filename']
+            print(f"Found matching schema: {detected_schema_id}")
+            
             # Validate the JSON object against the schema
             if jsonschema_available:
                 try:
-                    # Create a schema store for resolving $ref references
-                    schema_store = {}
-                    for schema_info in schemas:
-                        # Use the schema ID as the key for the store
-                        schema_id = schema_info['id']
-                        schema_store[schema_id] = schema_info['schema']
-                        print(f"Added schema to store: {schema_id}")
-                    
-                    print(f"Schema store keys: {list(schema_store.keys())}")
+                    validator = get_schema_validator(preload_context, detected_schema_id, matching_schema)
                     
-                    # Create a resolver with the schema store
-                    resolver = RefResolver(base_uri="", referrer=matching_schema, store=schema_store)
-                    print(f"Created resolver for validation of schema: {detected_schema_id}")
-                    
-                    # Validate with the resolver
-                    validate(instance=json_object, schema=matching_schema, resolver=resolver)
+                    # RefResolver keeps a scope stack while validating, so shared validators validate one at a time
+                    with preload_context['lock']:
+                        error = jsonschema.exceptions.best_match(validator.iter_errors(json_object))
+                    if error is not None:
+                        raise error
+                    if progress_callback:
+                        progress_callback({'event': 'validated', 'attempt': attempts, 'root_schema': detected_schema_id})
                     
                     # Success! Return the result
                     return {
@@ -925,6 +1572,8 @@ Be sure to distinctly include both detected_schema and json_object (compliant) i
                 except ValidationError as e:
                     validation_error = str(e)
                     print(f"Validation error on attempt {attempts}: {validation_error}")
+                    if progress_callback:
+                        progress_callback({'event': 'validation_failed', 'attempt': attempts, 'error': e.message})
                     
                     if attempts < max_attempts:
                         # Add validation error to the prompt for retry
@@ -988,7 +1637,7 @@ Be sure to distinctly include both detected_schema and json_object (compliant) i
         'attempts': attempts
     }
 
-def call_openai_api(system_prompt, user_prompt):
+def call_openai_api(system_prompt, user_prompt, max_tokens=2000):
     """Call OpenAI API and return the response"""
     headers = {
         'Authorization': f'Bearer {openai_api_key}',
@@ -1001,7 +1650,7 @@ def call_openai_api(system_prompt, user_prompt):
             {'role': 'system', 'content': system_prompt},
             {'role': 'user', 'content': user_prompt}
         ],
-        'max_tokens': 2000,
+        'max_tokens': max_tokens,
         'temperature': 0.3
     }
     
@@ -1010,7 +1659,7 @@ def call_openai_api(system_prompt, user_prompt):
     
     # Create request
     req = urllib.request.Request(
-        'https://api.openai.com/v1/chat/completions',
+        f'{openai_api_base}/chat/completions',
         data=data,
         headers=headers,
         method='POST'
@@ -1035,11 +1684,65 @@ def call_openai_api(system_prompt, user_prompt):
     
     return generated_content.strip()
 
-def generate_schema_from_description(description):
-    """Generate JSON schema from plain English description using OpenAI"""
+def stream_openai_api(system_prompt, user_prompt, on_token):
+    """Call OpenAI with stream=True, passing each content delta to on_token, and return the full response"""
+    headers = {
+        'Authorization': f'Bearer {openai_api_key}',
+        'Content-Type': 'application/json',
+        'Accept': 'text/event-stream'
+    }
+    
+    payload = {
+        'model': 'gpt-3.5-turbo',
+        'messages': [
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': user_prompt}
+        ],
+        'max_tokens': 2000,
+        'temperature': 0.3,
+        'stream': True
+    }
+    
+    req = urllib.request.Request(
+        f'{openai_api_base}/chat/completions',
+        data=json.dumps(payload).encode('utf-8'),
+        headers=headers,
+        method='POST'
+    )
+    
+    chunks = []
+    with urllib.request.urlopen(req, timeout=30) as response:
+        if response.status != 200:
+            raise Exception(f"OpenAI API error: {response.status} - {response.read().decode()}")
+        
+        # Server-sent events: one "data: {...}" line per chunk, terminated by "data: [DONE]"
+        for raw_line in response:
+            line = raw_line.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            choices = json.loads(data).get('choices') or []
+            delta = choices[0].get('delta', {}).get('content') if choices else None
+            if delta:
+                chunks.append(delta)
+                on_token(delta)
+    
+    generated_content = ''.join(chunks).strip()
+    if not generated_content:
+        raise Exception("No response from OpenAI API")
+    
+    # Remove any markdown formatting if present
+    if generated_content.startswith('```json'):
+        generated_content = generated_content[7:]
+    if generated_content.endswith('```'):
+        generated_content = generated_content[:-3]
     
-    # Pre-prompt for the API call
-    system_prompt = """You are a JSON Schema expert. Convert plain English descriptions into valid JSON Schema format.
+    return generated_content.strip()
+
+# Pre-prompt shared by single and batch schema generation
+SCHEMA_GENERATION_SYSTEM_PROMPT = """You are a JSON Schema expert. Convert plain English descriptions into valid JSON Schema format.
 
 Requirements:
 1. Return ONLY valid JSON Schema (JSON Schema Draft 2019-09)
@@ -1116,29 +1819,257 @@ A sample object complying with the previous would be:
 }
 """
 
-    user_prompt = f"Convert this description to JSON Schema: {description}"
-    
-    headers = {
-        'Authorization': f'Bearer {openai_api_key}',
-        'Content-Type': 'application/json'
-    }
+SCHEMA_BATCH_INSTRUCTIONS = """
+
+You will be given several numbered descriptions that belong to the same tenant and may reference each other.
+Generate all of the schemas together so that every $ref points at the $id of another schema in this response
+(or at one of the already existing schemas listed by the user).
+
+Return ONLY a JSON object of this form, with one schema per description, in the same order:
+{
+  "schemas": [ { ...schema for description 1... }, { ...schema for description 2... } ]
+}
+"""
+
+# gpt-3.5-turbo rejects requests asking for more completion tokens than this
+OPENAI_MAX_COMPLETION_TOKENS = 4096
+SCHEMA_BATCH_TOKENS_PER_DESCRIPTION = 1000
+# A batch is one completion, so it can only hold as many schemas as fit in the completion limit
+SCHEMA_BATCH_MAX_DESCRIPTIONS = OPENAI_MAX_COMPLETION_TOKENS // SCHEMA_BATCH_TOKENS_PER_DESCRIPTION
+
+def get_ref_target(ref):
+    """Normalize a $ref to the schema filename it points at, or None for local (#...) refs"""
+    if not isinstance(ref, str):
+        return None
+    target = ref.split('#', 1)[0].rsplit('/', 1)[-1]
+    if not target:
+        return None
+    return target if target.endswith('.json') else f"{target}.json"
+
+def collect_schema_refs(schema):
+    """Return the set of schema filenames referenced anywhere inside a schema via $ref"""
+    refs = set()
+    pending = [schema]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, dict):
+            target = get_ref_target(node.get('$ref'))
+            if target:
+                refs.add(target)
+            pending.extend(node.values())
+        elif isinstance(node, list):
+            pending.extend(node)
+    return refs
+
+def list_tenant_schema_files(tenant_id):
+    """Return the filenames of the .json schemas already stored for a tenant"""
+    filenames = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"schemas/{tenant_id}/"):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json'):
+                filenames.add(obj['Key'].split('/')[-1])
+    return filenames
+
+def get_ref_graph_key(tenant_id):
+    """S3 key of a tenant's $ref graph index (not .json, so schema loaders and the server skip it)"""
+    return f"schemas/{tenant_id}/ref-graph.idx"
+
+def build_ref_graph(schemas):
+    """Build the $ref dependency graph of a tenant's schemas.
     
-    payload = {
-        'model': 'gpt-3.5-turbo',
-        'messages': [
-            {'role': 'system', 'content': system_prompt},
-            {'role': 'user', 'content': user_prompt}
-        ],
-        'max_tokens': 1000,
-        'temperature': 0.3
-    }
+    Nodes are schema filenames. Refs are matched to filenames exactly, then by $id, then
+    case-insensitively. Returns forward edges, reverse edges, transitive closures and any
+    refs that point at no schema.
+    """
+    filenames = sorted(schema_info['filename'] for schema_info in schemas)
+    resolve = {filename.casefold(): filename for filename in filenames}
+    for schema_info in schemas:
+        id_target = get_ref_target(schema_info['id'])
+        if id_target:
+            resolve.setdefault(id_target.casefold(), schema_info['filename'])
+    for filename in filenames:
+        resolve[filename] = filename
+    
+    edges = {filename: [] for filename in filenames}
+    dangling = {}
+    for schema_info in schemas:
+        targets = set()
+        for ref in collect_schema_refs(schema_info['schema']):
+            target = resolve.get(ref) or resolve.get(ref.casefold())
+            if target:
+                targets.add(target)
+            else:
+                dangling.setdefault(schema_info['filename'], []).append(ref)
+        edges[schema_info['filename']] = sorted(targets)
+    
+    reverse_edges = {filename: [] for filename in filenames}
+    for source, targets in edges.items():
+        for target in targets:
+            reverse_edges[target].append(source)
+    
+    closures = {}
+    for root in filenames:
+        seen = set()
+        pending = list(edges[root])
+        while pending:
+            node = pending.pop()
+            if node not in seen:
+                seen.add(node)
+                pending.extend(edges[node])
+        seen.discard(root)
+        closures[root] = sorted(seen)
+    
+    return {
+        'schemas': filenames,
+        'edges': edges,
+        'reverse_edges': {target: sorted(sources) for target, sources in reverse_edges.items()},
+        'closures': closures,
+        'dangling': {source: sorted(refs) for source, refs in dangling.items()}
+    }
+
+def update_ref_graph(tenant_id):
+    """Rebuild and store a tenant's $ref graph index; returns the index, or None on failure"""
+    try:
+        ref_graph = build_ref_graph(load_tenant_schemas(tenant_id))
+        ref_graph['tenant_id'] = tenant_id
+        ref_graph['built_at'] = datetime.utcnow().isoformat()
+        put_tenant_object(
+            tenant_id,
+            get_ref_graph_key(tenant_id),
+            json.dumps(ref_graph),
+            ContentType='application/json'
+        )
+        print(f"Updated $ref graph for tenant {tenant_id}: {len(ref_graph['schemas'])} schemas, {len(ref_graph['dangling'])} with dangling refs")
+        return ref_graph
+    except Exception as e:
+        print(f"Error updating $ref graph for tenant {tenant_id}: {str(e)}")
+        return None
+
+def load_ref_graph(tenant_id):
+    """Load a tenant's stored $ref graph index, or None if it has not been built"""
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=get_ref_graph_key(tenant_id))
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        print(f"Error loading $ref graph for tenant {tenant_id}: {str(e)}")
+        return None
+
+def get_schema_closure(ref_graph, root_schema):
+    """Filenames of a root schema and everything it transitively references, or [] if the root is unknown"""
+    target = get_ref_target(root_schema)
+    if not target:
+        return []
+    by_casefold = {filename.casefold(): filename for filename in ref_graph['schemas']}
+    root = target if target in ref_graph['closures'] else by_casefold.get(target.casefold())
+    if not root:
+        return []
+    return [root] + ref_graph['closures'][root]
+
+def generate_schema_batch(tenant_id, descriptions, progress_callback=None):
+    """Generate schemas for all descriptions in a single OpenAI call.
+    
+    Returns (generated_schemas, failed_schemas, dangling_refs). Every $ref is checked against the
+    returned $ids and the tenant's existing schemas; schemas with unresolved refs are not returned.
+    """
+    try:
+        existing_files = list_tenant_schema_files(tenant_id)
+    except Exception as e:
+        print(f"Error listing existing schemas for tenant {tenant_id}: {str(e)}")
+        existing_files = set()
+    
+    system_prompt = SCHEMA_GENERATION_SYSTEM_PROMPT + SCHEMA_BATCH_INSTRUCTIONS
+    user_prompt = "Convert these descriptions to JSON Schemas:\n"
+    for i, description in enumerate(descriptions):
+        user_prompt += f"{i + 1}. {description}\n"
+    if existing_files:
+        user_prompt += f"\nAlready existing schemas that may also be referenced: {sorted(existing_files)}\n"
+    
+    max_attempts = 2
+    schemas = []
+    dangling_refs = {}
+    
+    for attempt in range(1, max_attempts + 1):
+        try:
+            response_data = json.loads(call_openai_api(
+                system_prompt,
+                user_prompt,
+                max_tokens=min(SCHEMA_BATCH_TOKENS_PER_DESCRIPTION * len(descriptions), OPENAI_MAX_COMPLETION_TOKENS)
+            ))
+            schemas = response_data.get('schemas') if isinstance(response_data, dict) else None
+            if not isinstance(schemas, list) or not all(isinstance(schema, dict) for schema in schemas):
+                raise Exception("Response did not contain a list of schemas")
+            if len(schemas) != len(descriptions):
+                raise Exception(f"Expected {len(descriptions)} schemas but received {len(schemas)}")
+        except Exception as e:
+            print(f"Error generating schema batch on attempt {attempt}: {str(e)}")
+            if attempt == max_attempts:
+                return [], [f"description_{i}" for i in range(len(descriptions))], {}
+            user_prompt += f"\n\nPrevious attempt failed: {str(e)}\nPlease try again."
+            continue
+        
+        known_files = set(existing_files)
+        for schema in schemas:
+            target = get_ref_target(schema.get('$id'))
+            if target:
+                known_files.add(target)
+        
+        dangling_refs = {}
+        for i, schema in enumerate(schemas):
+            missing = sorted(ref for ref in collect_schema_refs(schema) if ref not in known_files)
+            if missing:
+                dangling_refs[schema.get('$id', f"schema_{i}")] = missing
+        
+        if progress_callback:
+            progress_callback({'event': 'batch_generated', 'attempt': attempt, 'count': len(schemas), 'dangling_refs': dangling_refs})
+        
+        if not dangling_refs:
+            break
+        
+        print(f"Dangling $refs in schema batch on attempt {attempt}: {dangling_refs}")
+        if attempt < max_attempts:
+            user_prompt += f"\n\nThese $refs do not match any schema $id: {json.dumps(dangling_refs)}\nPlease fix the references."
+    
+    generated_schemas = []
+    failed_schemas = []
+    for i, schema in enumerate(schemas):
+        schema_id = schema.get('$id', f"schema_{i}")
+        if schema_id in dangling_refs:
+            failed_schemas.append(f"description_{i} (dangling $ref: {', '.join(dangling_refs[schema_id])})")
+        else:
+            generated_schemas.append(json.dumps(schema))
+    
+    return generated_schemas, failed_schemas, dangling_refs
+
+def generate_schema_from_description(description):
+    """Generate JSON schema from plain English description using OpenAI"""
+    
+    system_prompt = SCHEMA_GENERATION_SYSTEM_PROMPT
+    user_prompt = f"Convert this description to JSON Schema: {description}"
+    
+    headers = {
+        'Authorization': f'Bearer {openai_api_key}',
+        'Content-Type': 'application/json'
+    }
+    
+    payload = {
+        'model': 'gpt-3.5-turbo',
+        'messages': [
+            {'role': 'system', 'content': system_prompt},
+            {'role': 'user', 'content': user_prompt}
+        ],
+        'max_tokens': 1000,
+        'temperature': 0.3
+    }
     
     # Convert payload to JSON bytes
     data = json.dumps(payload).encode('utf-8')
     
     # Create request
     req = urllib.request.Request(
-        'https://api.openai.com/v1/chat/completions',
+        f'{openai_api_base}/chat/completions',
         data=data,
         headers=headers,
         method='POST'
@@ -1169,6 +2100,312 @@ A sample object complying with the previous would be:
     
     return generated_schema.strip()
 
+# In-memory job store used when ASYNC_JOB_BACKEND=local
+_local_jobs = {}
+_local_job_claims = {}
+_local_job_claims_lock = threading.Lock()
+
+def get_job_key(tenant_id, job_id):
+    """S3 key holding the state of an async job"""
+    return f"jobs/{tenant_id}/{job_id}.json"
+
+def save_job(job):
+    """Persist an async job record"""
+    job['updated_at'] = datetime.utcnow().isoformat()
+    if async_job_backend == 'local':
+        _local_jobs[get_job_key(job['tenant_id'], job['job_id'])] = json.loads(json.dumps(job, cls=DecimalEncoder))
+        return
+    s3.put_object(
+        Bucket=bucket_name,
+        Key=get_job_key(job['tenant_id'], job['job_id']),
+        Body=json.dumps(job, cls=DecimalEncoder),
+        ContentType='application/json'
+    )
+
+def load_job(tenant_id, job_id):
+    """Load an async job record, or None if it does not exist"""
+    key = get_job_key(tenant_id, job_id)
+    if async_job_backend == 'local':
+        job = _local_jobs.get(key)
+        return json.loads(json.dumps(job)) if job else None
+    try:
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        return None
+
+def claim_job(tenant_id, job_id):
+    """Atomically claim a job for one worker; False if another delivery already has it"""
+    now = datetime.utcnow()
+    if async_job_backend == 'local':
+        with _local_job_claims_lock:
+            if job_id in _local_job_claims:
+                return False
+            _local_job_claims[job_id] = now.isoformat()
+            return True
+    try:
+        job_claims_table.put_item(
+            Item={
+                'job_id': job_id,
+                'tenant_id': tenant_id,
+                'claimed_at': now.isoformat(),
+                'expires_at': int((now + timedelta(days=7)).timestamp())
+            },
+            ConditionExpression='attribute_not_exists(job_id)'
+        )
+        return True
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def get_job_claimed_at(job_id):
+    """When a worker claimed the job, or None if no worker has yet"""
+    if async_job_backend == 'local':
+        with _local_job_claims_lock:
+            return _local_job_claims.get(job_id)
+    claim = job_claims_table.get_item(Key={'job_id': job_id}).get('Item')
+    return claim['claimed_at'] if claim else None
+
+def is_job_abandoned(job):
+    """A job its worker started (or claimed) longer ago than the function timeout will never be finished"""
+    if job['status'] == 'running':
+        started_at = job.get('started_at')
+    elif job['status'] == 'queued':
+        # Claimed but never marked running: the worker died between the claim and its first save,
+        # and no other delivery can take the job over
+        started_at = get_job_claimed_at(job['job_id'])
+    else:
+        return False
+    if not started_at:
+        return False
+    return datetime.utcnow() - datetime.fromisoformat(started_at) > timedelta(seconds=async_job_timeout_seconds)
+
+def dispatch_job(tenant_id, job_id):
+    """Start the worker for a queued job without waiting for it to finish"""
+    dispatch_worker_event({
+        'type': 'job_worker',
+        'body': {'extension': tenant_id, 'job_id': job_id}
+    })
+
+def dispatch_worker_event(worker_event):
+    """Invoke this function asynchronously with an internal worker event"""
+    if async_job_backend == 'local' or not lambda_function_name:
+        # No Lambda to invoke (local development) - run the worker on a background thread
+        threading.Thread(target=lambda_handler, args=(worker_event, None), daemon=True).start()
+        return
+    lambda_client.invoke(
+        FunctionName=lambda_function_name,
+        InvocationType='Event',
+        Payload=json.dumps(worker_event).encode('utf-8')
+    )
+
+def is_valid_job_id(job_id):
+    """Job IDs are uuid4 hex strings; reject anything else before building an S3 key"""
+    return isinstance(job_id, str) and len(job_id) == 32 and all(c in string.hexdigits for c in job_id)
+
+def handle_async_job_submit(request_type, body):
+    """Queue an LLM request as a background job and return its job ID immediately"""
+    tenant_id = body.get('extension')
+    if not openai_api_key:
+        return create_response(500, {'error': 'OpenAI API key not configured'})
+    
+    request_body = {key: value for key, value in body.items() if key != 'async'}
+    now = datetime.utcnow().isoformat()
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'tenant_id': tenant_id,
+        'request_type': request_type,
+        'status': 'queued',
+        'created_at': now,
+        'progress': [],
+        'request': request_body
+    }
+    
+    try:
+        save_job(job)
+        dispatch_job(tenant_id, job['job_id'])
+        print(f"Queued {request_type} job {job['job_id']} for tenant {tenant_id}")
+    except Exception as e:
+        print(f"Error queueing {request_type} job for tenant {tenant_id}: {str(e)}")
+        return create_response(500, {'error': 'Failed to queue async job'})
+    
+    return create_response(202, {
+        'message': f'{request_type} job queued',
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'request_type': request_type
+    })
+
+def handle_job_worker(body):
+    """Run a queued async job and record its progress and result"""
+    tenant_id = body.get('extension')
+    job_id = body.get('job_id')
+    
+    if not is_valid_job_id(job_id):
+        return create_response(400, {'error': 'Invalid job_id'})
+    
+    job = load_job(tenant_id, job_id)
+    if not job:
+        return create_response(404, {'error': 'Job not found'})
+    
+    # Async invokes can be delivered more than once - only the delivery that wins the claim runs the job
+    if job['status'] != 'queued' or not claim_job(tenant_id, job_id):
+        print(f"Job {job_id} already claimed ({job['status']}) - skipping duplicate delivery")
+        return create_response(200, {'job_id': job_id, 'status': job['status']})
+    
+    job['status'] = 'running'
+    job['started_at'] = datetime.utcnow().isoformat()
+    save_job(job)
+    
+    def report_progress(progress_event):
+        job['progress'].append({**progress_event, 'at': datetime.utcnow().isoformat()})
+        try:
+            save_job(job)
+        except Exception as e:
+            print(f"Error saving progress for job {job_id}: {str(e)}")
+    
+    try:
+        if job['request_type'] == 'llm-preload':
+            response = handle_llm_preload(job['request'], progress_callback=report_progress)
+        elif job['request_type'] == 'llm-preload-batch':
+            response = handle_llm_preload_batch(job['request'], progress_callback=report_progress)
+        else:
+            response = handle_llm(job['request'], progress_callback=report_progress)
+        
+        job['status'] = 'succeeded' if response['statusCode'] < 400 else 'failed'
+        job['result'] = {
+            'statusCode': response['statusCode'],
+            'body': json.loads(response['body'])
+        }
+    except Exception as e:
+        print(f"Error running job {job_id}: {str(e)}")
+        job['status'] = 'failed'
+        job['result'] = {'statusCode': 500, 'body': {'error': 'Job failed'}}
+    
+    job['completed_at'] = datetime.utcnow().isoformat()
+    save_job(job)
+    print(f"Job {job_id} finished with status {job['status']}")
+    
+    return create_response(200, {'job_id': job_id, 'status': job['status']})
+
+def handle_job_status(body):
+    """Return the status, progress and (once finished) result of an async job"""
+    tenant_id = body.get('extension')
+    job_id = body.get('job_id')
+    
+    if not is_valid_job_id(job_id):
+        return create_response(400, {'error': 'A valid job_id is required'})
+    
+    try:
+        job = load_job(tenant_id, job_id)
+    except Exception as e:
+        print(f"Error loading job {job_id}: {str(e)}")
+        return create_response(500, {'error': 'Failed to load job status'})
+    
+    if not job:
+        return create_response(404, {'error': 'Job not found'})
+    
+    # The worker timed out mid-run and can't record that itself
+    try:
+        abandoned = is_job_abandoned(job)
+    except Exception as e:
+        print(f"Error checking whether job {job_id} was abandoned: {str(e)}")
+        abandoned = False
+    if abandoned:
+        job['status'] = 'failed'
+        job['result'] = {'statusCode': 504, 'body': {'error': 'Job timed out'}}
+        job['completed_at'] = datetime.utcnow().isoformat()
+        try:
+            save_job(job)
+        except Exception as e:
+            print(f"Error marking job {job_id} as timed out: {str(e)}")
+    
+    # Never echo the original request back - it may carry tokens
+    job.pop('request', None)
+    return create_response(200, job)
+
+def format_sse(event):
+    """Format a progress event as a server-sent event"""
+    return f"event: {event['event']}\ndata: {json.dumps(event, cls=DecimalEncoder)}\n\n"
+
+def iter_llm_preload_events(body):
+    """Run llm-preload and yield its events as they happen.
+    
+    Yields attempt, token and validation events while the model is generating, then a single
+    'result' event carrying the same statusCode/body the synchronous handler would return.
+    """
+    events = queue.Queue()
+    
+    def run():
+        try:
+            response = handle_llm_preload(body, progress_callback=events.put, stream_tokens=True)
+            result = {'statusCode': response['statusCode'], 'body': json.loads(response['body'])}
+        except Exception as e:
+            print(f"Error in streamed LLM preload: {str(e)}")
+            result = {'statusCode': 500, 'body': {'error': 'Failed to process LLM preload request'}}
+        events.put({'event': 'result', **result})
+    
+    threading.Thread(target=run, daemon=True).start()
+    
+    while True:
+        event = events.get()
+        yield event
+        if event['event'] == 'result':
+            return
+
+def run_llm_preload_stream_server(host='127.0.0.1', port=8081):
+    """Serve POST /llm-preload-stream as a chunked text/event-stream response.
+    
+    Python Lambdas cannot use response streaming, so this adapter is what the editor (or a
+    proxy in front of it) talks to when it wants tokens as they arrive.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class LlmPreloadStreamHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def do_OPTIONS(self):
+            self.send_response(204)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+            self.send_header('Access-Control-Allow-Methods', 'POST,OPTIONS')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        
+        def do_POST(self):
+            if self.path.rstrip('/') != '/llm-preload-stream':
+                self.send_error(404)
+                return
+            
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+            except (ValueError, json.JSONDecodeError):
+                self.send_error(400, 'Invalid JSON in request body')
+                return
+            # Accept either the API Gateway style {"type", "body"} envelope or a bare body
+            body = request.get('body', request) if isinstance(request, dict) else None
+            if not isinstance(body, dict):
+                self.send_error(400, 'Invalid body: must be JSON object')
+                return
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            
+            for event in iter_llm_preload_events(body):
+                chunk = format_sse(event).encode('utf-8')
+                self.wfile.write(f"{len(chunk):X}\r\n".encode('ascii') + chunk + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+    
+    server = ThreadingHTTPServer((host, port), LlmPreloadStreamHandler)
+    print(f"Serving llm-preload stream on http://{host}:{port}/llm-preload-stream")
+    server.serve_forever()
+
 def verify_google_token_and_permissions(access_token, tenant_id):
     """Verify Google access token and get user permissions from DynamoDB"""
     try:
@@ -1345,7 +2582,7 @@ def handle_auth(body):
                     # User exists in billing-admins table - they are a billing admin
                     is_billing_admin = True
                     stripe_account_id = billing_admin.get('stripe_account_id')
-                    token_balance = int(math.floor(float(billing_admin.get('token_balance', 0))))
+                    token_balance = get_token_balance(auth_result['user_email'], billing_admin)
                     
                     # Update last activity
                     billing_table.update_item(
@@ -1432,10 +2669,13 @@ def handle_admin_delete(body):
         )
         
         deleted_s3_count = 0
+        deleted_s3_bytes = 0
         if 'Contents' in s3_objects:
             for obj in s3_objects['Contents']:
                 s3.delete_object(Bucket=bucket_name, Key=obj['Key'])
                 deleted_s3_count += 1
+                deleted_s3_bytes += obj['Size']
+        adjust_storage_counter(target_tenant, -deleted_s3_bytes)
         
         # Delete all DynamoDB entries for the tenant
         deleted_dynamo_count = 0
@@ -1740,43 +2980,188 @@ def handle_oauth_token_exchange(body):
         return create_response(500, {'error': 'Failed to exchange OAuth token'})
 
 
-def handle_stripe_webhook(body, event):
-    """Handle Stripe webhook events"""
+def handle_stripe_webhook(raw_body, event):
+    """Verify a Stripe webhook, record it once and acknowledge it before any processing happens"""
     try:
-        # Verify webhook signature
-        headers = event.get('headers', {})
+        headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
         signature = headers.get('stripe-signature')
         
         if not signature or not stripe_webhook_secret:
             return create_response(400, {'error': 'Missing webhook signature or secret'})
         
-        # Verify the webhook signature
+        # A re-serialized body never matches Stripe's signature, so only the raw payload is accepted
+        if not isinstance(raw_body, str):
+            return create_response(400, {'error': 'Webhook body must be the raw request payload'})
+        
         try:
-            stripe.Webhook.construct_event(
-                json.dumps(body),
-                signature,
-                stripe_webhook_secret
-            )
+            stripe_event = stripe.Webhook.construct_event(raw_body, signature, stripe_webhook_secret)
         except ValueError:
             return create_response(400, {'error': 'Invalid payload'})
         except stripe.error.SignatureVerificationError:
             return create_response(400, {'error': 'Invalid signature'})
         
-        # Handle different event types
-        event_type = body.get('type')
-        
-        if event_type == 'checkout.session.completed':
-            return handle_checkout_completed(body)
-        elif event_type == 'customer.created':
-            return handle_customer_created(body)
-        else:
+        event_id = stripe_event['id']
+        event_type = stripe_event['type']
+        if event_type not in STRIPE_HANDLED_EVENT_TYPES:
             return create_response(200, {'message': f'Unhandled event type: {event_type}'})
+        
+        # Stripe retries until it gets a 2xx, so the same event can arrive many times - only the first is queued
+        now = datetime.utcnow()
+        try:
+            stripe_events_table.put_item(
+                Item={
+                    'event_id': event_id,
+                    'event_type': event_type,
+                    'status': 'queued',
+                    'payload': raw_body,
+                    'received_at': now.isoformat(),
+                    'dispatched_at': now.isoformat(),
+                    'attempts': 0,
+                    'expires_at': int((now + timedelta(days=STRIPE_EVENT_RETENTION_DAYS)).timestamp())
+                },
+                ConditionExpression='attribute_not_exists(event_id)'
+            )
+        except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            # A redelivery is also the chance to restart an event whose processing failed or died
+            record = stripe_events_table.get_item(Key={'event_id': event_id}, ConsistentRead=True).get('Item')
+            if record and is_stripe_event_stuck(record) and redispatch_stripe_event(record):
+                print(f"Stripe event {event_id} was {record['status']} - dispatched it again")
+                return create_response(200, {'received': True, 'event_id': event_id, 'redispatched': True})
+            print(f"Stripe event {event_id} already received - acknowledging duplicate")
+            return create_response(200, {'received': True, 'event_id': event_id, 'duplicate': True})
+        
+        try:
+            dispatch_worker_event({'type': 'stripe_event_worker', 'body': {'event_id': event_id}})
+        except Exception as e:
+            # Forget the event so Stripe's retry can queue it again
+            print(f"Error dispatching Stripe event {event_id}: {str(e)}")
+            stripe_events_table.delete_item(Key={'event_id': event_id})
+            return create_response(500, {'error': 'Failed to queue webhook event'})
+        
+        print(f"Queued Stripe event {event_id} ({event_type})")
+        return create_response(200, {'received': True, 'event_id': event_id})
             
     except Exception as e:
         print(f"Error handling webhook: {str(e)}")
         return create_response(500, {'error': 'Failed to process webhook'})
 
 
+def is_stripe_event_stuck(record):
+    """True if a recorded event has to be dispatched again: it failed, or its worker never started or died"""
+    if int(record.get('attempts', 0)) >= STRIPE_EVENT_MAX_ATTEMPTS:
+        return False
+    # A live worker finishes within one function timeout
+    stale_before = (datetime.utcnow() - timedelta(seconds=async_job_timeout_seconds)).isoformat()
+    if record['status'] == 'failed':
+        return True
+    if record['status'] == 'queued':
+        return record['dispatched_at'] < stale_before
+    if record['status'] == 'processing':
+        return record['started_at'] < stale_before
+    return False
+
+def redispatch_stripe_event(record):
+    """Dispatch a stuck event again; False if a concurrent redelivery or sweep already did"""
+    try:
+        stripe_events_table.update_item(
+            Key={'event_id': record['event_id']},
+            UpdateExpression='SET dispatched_at = :now',
+            ConditionExpression='dispatched_at = :seen',
+            ExpressionAttributeValues={':now': datetime.utcnow().isoformat(), ':seen': record['dispatched_at']}
+        )
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    dispatch_worker_event({'type': 'stripe_event_worker', 'body': {'event_id': record['event_id']}})
+    return True
+
+def retry_stripe_events():
+    """Dispatch every recorded Stripe event that failed or stalled; returns a summary"""
+    summary = {'events_checked': 0, 'events_redispatched': 0, 'events_given_up': 0}
+    scan_kwargs = {
+        'ProjectionExpression': 'event_id, #status, dispatched_at, started_at, attempts',
+        'FilterExpression': '#status <> :processed',
+        'ExpressionAttributeNames': {'#status': 'status'},
+        'ExpressionAttributeValues': {':processed': 'processed'}
+    }
+    while True:
+        response = stripe_events_table.scan(**scan_kwargs)
+        for record in response.get('Items', []):
+            summary['events_checked'] += 1
+            if int(record.get('attempts', 0)) >= STRIPE_EVENT_MAX_ATTEMPTS:
+                summary['events_given_up'] += 1
+                continue
+            try:
+                if is_stripe_event_stuck(record) and redispatch_stripe_event(record):
+                    summary['events_redispatched'] += 1
+            except Exception as e:
+                print(f"Error re-dispatching Stripe event {record['event_id']}: {str(e)}")
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    print(f"Stripe event retry: {summary}")
+    return summary
+
+def handle_stripe_event_worker(body):
+    """Process a queued Stripe event; duplicate deliveries of the same event are skipped"""
+    event_id = body.get('event_id')
+    if not isinstance(event_id, str) or not event_id.startswith('evt_'):
+        return create_response(400, {'error': 'Invalid event_id'})
+    
+    now = datetime.utcnow()
+    try:
+        # Claim the event: queued, failed, or abandoned by a worker that died mid-run
+        record = stripe_events_table.update_item(
+            Key={'event_id': event_id},
+            UpdateExpression='SET #status = :processing, started_at = :now ADD attempts :one',
+            ConditionExpression='(#status IN (:queued, :failed) OR (#status = :processing AND started_at < :stale)) '
+                                'AND (attribute_not_exists(attempts) OR attempts < :max_attempts)',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':processing': 'processing',
+                ':queued': 'queued',
+                ':failed': 'failed',
+                ':now': now.isoformat(),
+                ':stale': (now - timedelta(seconds=async_job_timeout_seconds)).isoformat(),
+                ':one': 1,
+                ':max_attempts': STRIPE_EVENT_MAX_ATTEMPTS
+            },
+            ReturnValues='ALL_NEW'
+        )['Attributes']
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        print(f"Stripe event {event_id} already claimed - skipping duplicate delivery")
+        return create_response(200, {'event_id': event_id, 'skipped': True})
+    
+    stripe_event = json.loads(record['payload'])
+    try:
+        if record['event_type'] == 'checkout.session.completed':
+            response = handle_checkout_completed(stripe_event)
+        else:
+            response = handle_customer_created(stripe_event)
+        status = 'processed' if response['statusCode'] < 400 else 'failed'
+        result_code = response['statusCode']
+    except Exception as e:
+        print(f"Error processing Stripe event {event_id}: {str(e)}")
+        status = 'failed'
+        result_code = 500
+    
+    stripe_events_table.update_item(
+        Key={'event_id': event_id},
+        UpdateExpression='SET #status = :status, completed_at = :now, result_code = :code',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={
+            ':status': status,
+            ':now': datetime.utcnow().isoformat(),
+            ':code': result_code
+        }
+    )
+    if status == 'failed' and int(record['attempts']) >= STRIPE_EVENT_MAX_ATTEMPTS:
+        print(f"Stripe event {event_id} failed {record['attempts']} times - giving up")
+    print(f"Stripe event {event_id} finished with status {status}")
+    
+    return create_response(200, {'event_id': event_id, 'status': status})
+
+
 def handle_checkout_completed(event_data):
     """Handle successful checkout completion"""
     try:
@@ -1931,6 +3316,96 @@ def handle_create_account_link(body):
         print(f"Error creating account link: {str(e)}")
         return create_response(500, {'error': 'Failed to create account link'})
 
+def fetch_stripe_account_status(account_id):
+    """Ask Stripe whether a connected account can accept payments yet"""
+    account = stripe.Account.retrieve(account_id)
+    charges_enabled = bool(account.get('charges_enabled', False))
+    return {
+        'charges_enabled': charges_enabled,
+        'details_submitted': bool(account.get('details_submitted', False)),
+        'status': 'active' if charges_enabled else 'pending',
+        'checked_at': int(time.time())
+    }
+
+def save_stripe_account_status(user_email, account_id, account_status):
+    """Cache a Stripe account status on the billing admin that owns the account"""
+    billing_table.update_item(
+        Key={'user_email': user_email},
+        UpdateExpression='SET stripe_account_status = :status, stripe_charges_enabled = :charges, '
+                         'stripe_details_submitted = :details, stripe_status_checked_at = :checked',
+        # Never attach a status to an item whose account has since been replaced
+        ConditionExpression='stripe_account_id = :account_id',
+        ExpressionAttributeValues={
+            ':status': account_status['status'],
+            ':charges': account_status['charges_enabled'],
+            ':details': account_status['details_submitted'],
+            ':checked': account_status['checked_at'],
+            ':account_id': account_id
+        }
+    )
+
+def get_stripe_account_status(billing_admin, force_refresh=False):
+    """Stripe account status for a billing admin, from the cached copy while it is fresh"""
+    checked_at = billing_admin.get('stripe_status_checked_at')
+    if not force_refresh and checked_at is not None and time.time() - float(checked_at) < stripe_account_status_ttl_seconds:
+        return {
+            'charges_enabled': billing_admin['stripe_charges_enabled'],
+            'details_submitted': billing_admin['stripe_details_submitted'],
+            'status': billing_admin['stripe_account_status'],
+            'checked_at': int(checked_at),
+            'cached': True
+        }
+    
+    account_status = fetch_stripe_account_status(billing_admin['stripe_account_id'])
+    try:
+        save_stripe_account_status(billing_admin['user_email'], billing_admin['stripe_account_id'], account_status)
+    except Exception as e:
+        # The fresh status is still good to return; the next read just refreshes again
+        print(f"Error caching Stripe account status for {billing_admin['user_email']}: {str(e)}")
+    return {**account_status, 'cached': False}
+
+def refresh_pending_stripe_accounts(concurrency=None):
+    """Re-sync the cached status of every Stripe account that can't take charges yet; returns a summary"""
+    if not isinstance(concurrency, int) or concurrency < 1:
+        concurrency = billing_concurrency
+    concurrency = min(concurrency, BILLING_MAX_CONCURRENCY)
+    pending_admins = []
+    scan_kwargs = {
+        'ProjectionExpression': 'user_email, stripe_account_id',
+        'FilterExpression': 'attribute_exists(stripe_account_id) AND '
+                            '(attribute_not_exists(stripe_charges_enabled) OR stripe_charges_enabled = :false)',
+        'ExpressionAttributeValues': {':false': False}
+    }
+    while True:
+        response = billing_table.scan(**scan_kwargs)
+        pending_admins.extend(item for item in response.get('Items', []) if item.get('stripe_account_id'))
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    summary = {'accounts_checked': 0, 'accounts_activated': 0, 'failed_accounts': 0}
+    
+    def refresh(billing_admin):
+        account_status = fetch_stripe_account_status(billing_admin['stripe_account_id'])
+        save_stripe_account_status(billing_admin['user_email'], billing_admin['stripe_account_id'], account_status)
+        return account_status
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(refresh, billing_admin): billing_admin for billing_admin in pending_admins}
+        for future in concurrent.futures.as_completed(futures):
+            billing_admin = futures[future]
+            try:
+                account_status = future.result()
+                summary['accounts_checked'] += 1
+                if account_status['charges_enabled']:
+                    summary['accounts_activated'] += 1
+            except Exception as e:
+                print(f"Error refreshing Stripe account {billing_admin['stripe_account_id']}: {str(e)}")
+                summary['failed_accounts'] += 1
+    
+    print(f"Stripe account refresh: {summary}")
+    return summary
+
 def handle_check_account_status(body):
     """Handle checking Stripe account status and user token balance"""
     try:
@@ -1947,7 +3422,7 @@ def handle_check_account_status(body):
                 
                 if 'Item' in response:
                     billing_data = response['Item']
-                    token_balance = int(math.floor(float(billing_data.get('token_balance', 0))))
+                    token_balance = get_token_balance(user_email, billing_data)
                     total_tokens_purchased = int(math.floor(float(billing_data.get('total_tokens_purchased', 0))))
                     last_payment_date = int(math.floor(float(billing_data.get('last_payment_date', 0))))
                     last_payment_amount = int(math.floor(float(billing_data.get('last_payment_amount', 0))))
@@ -1978,33 +3453,22 @@ def handle_check_account_status(body):
             if not stripe_secret_key:
                 return create_response(500, {'error': 'Stripe not configured'})
             
-            # Retrieve account details from Stripe
-            account = stripe.Account.retrieve(account_id)
-            
-            # Check if account is ready to accept payments
-            charges_enabled = account.get('charges_enabled', False)
-            details_submitted = account.get('details_submitted', False)
+            # The status is cached on the tenant's billing admin, so the account must belong to them
+            billing_admin = None
+            owner_email = get_billing_user_for_tenant(tenant_id) if tenant_id else None
+            if owner_email:
+                billing_admin = billing_table.get_item(Key={'user_email': owner_email}).get('Item')
             
-            # Update billing admin with account status
-            try:
-                billing_table.update_item(
-                    Key={'stripe_account_id': account_id},
-                    UpdateExpression='SET account_status = :status, charges_enabled = :charges, last_activity = :activity',
-                    ExpressionAttributeValues={
-                        ':status': 'active' if charges_enabled else 'pending',
-                        ':charges': charges_enabled,
-                        ':activity': datetime.utcnow().isoformat()
-                    }
-                )
-            except Exception as e:
-                print(f"Error updating billing admin status: {str(e)}")
+            if billing_admin and billing_admin.get('stripe_account_id') == account_id:
+                account_status = get_stripe_account_status(billing_admin, force_refresh=body.get('refresh') is True)
+            else:
+                print(f"No billing admin owns Stripe account {account_id} for tenant {tenant_id} - not caching status")
+                account_status = fetch_stripe_account_status(account_id)
             
             return create_response(200, {
                 'message': 'Account status retrieved successfully',
                 'account_id': account_id,
-                'charges_enabled': charges_enabled,
-                'details_submitted': details_submitted,
-                'status': 'active' if charges_enabled else 'pending'
+                **account_status
             })
         else:
             return create_response(400, {'error': 'Either account_id or user_email is required'})
@@ -2041,8 +3505,19 @@ def handle_debit_tokens(body):
                 'payment_enforced': payment_enforced
             })
         
+        if debit_buffer_enabled and append_usage_events(billing_user_email, tokens_to_debit, operation_type, tenant_id=tenant_id):
+            # One durable append on the critical path instead of an update on the hot billing-admins item
+            return create_response(202, {
+                'message': 'Token debit queued',
+                'tenant_id': tenant_id,
+                'billing_user_email': billing_user_email,
+                'tokens_queued': tokens_to_debit,
+                'operation_type': operation_type,
+                'payment_enforced': payment_enforced
+            })
+        
         # ALWAYS debit tokens when a billing user is found, regardless of enforcement
-        success = debit_tokens_from_user(billing_user_email, tokens_to_debit, operation_type)
+        success = debit_tokens_from_user(billing_user_email, tokens_to_debit, operation_type, tenant_id=tenant_id)
         
         if success:
             return create_response(200, {
@@ -2070,8 +3545,33 @@ def handle_debit_tokens(body):
         print(f"Error in token debiting: {str(e)}")
         return create_response(500, {'error': 'Failed to process token debit request'})
 
+_billing_user_cache = {}  # tenant_id -> (user_email or None, time.monotonic() expiry)
+_billing_user_cache_lock = threading.Lock()
+
+def cache_billing_user(tenant_id, user_email):
+    """Remember a tenant's billing user (or that it has none) for this container"""
+    ttl = billing_user_cache_ttl_seconds if user_email else billing_user_cache_negative_ttl_seconds
+    now = time.monotonic()
+    with _billing_user_cache_lock:
+        if len(_billing_user_cache) >= BILLING_USER_CACHE_MAX_ENTRIES:
+            for cached_tenant in [t for t, (_, expires_at) in _billing_user_cache.items() if expires_at <= now]:
+                del _billing_user_cache[cached_tenant]
+            if len(_billing_user_cache) >= BILLING_USER_CACHE_MAX_ENTRIES:
+                _billing_user_cache.clear()
+        _billing_user_cache[tenant_id] = (user_email, now + ttl)
+
+def invalidate_billing_user_cache(tenant_id):
+    """Drop a cached lookup after the tenant's mapping may have been written"""
+    with _billing_user_cache_lock:
+        _billing_user_cache.pop(tenant_id, None)
+
 def get_billing_user_for_tenant(tenant_id):
     """Get the billing user email for a given tenant"""
+    with _billing_user_cache_lock:
+        cached = _billing_user_cache.get(tenant_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    
     try:
         # First try the new mapping table
         response = billing_user_from_tenant_table.query(
@@ -2081,34 +3581,109 @@ def get_billing_user_for_tenant(tenant_id):
         )
         
         if response['Items']:
-            return response['Items'][0]['user_email']
+            billing_user_email = response['Items'][0]['user_email']
+            cache_billing_user(tenant_id, billing_user_email)
+            return billing_user_email
         
         # No fallback - only use the new denormalized table
         print(f"No billing user found for tenant {tenant_id} in billinguser_from_tenant table")
         
+        # Errors below are not cached, only a definite "no mapping"
+        cache_billing_user(tenant_id, None)
         return None
         
     except Exception as e:
         print(f"Error getting billing user for tenant {tenant_id}: {str(e)}")
         return None
 
-def debit_tokens_from_user(user_email, tokens_to_debit, operation_type):
-    """Debit tokens from a user's account (allows negative balance)"""
+def load_tenant_billing_users(segments=None):
+    """Read the whole tenant -> billing user mapping with a parallel segmented scan; returns a dict or None"""
+    segments = segments or billing_user_scan_segments
+    
+    def scan_segment(segment):
+        items = []
+        scan_kwargs = {
+            'ProjectionExpression': 'tenant_id, user_email',
+            'Segment': segment,
+            'TotalSegments': segments
+        }
+        while True:
+            response = billing_user_from_tenant_table.scan(**scan_kwargs)
+            items.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return items
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+            segment_items = list(executor.map(scan_segment, range(segments)))
+        
+        billing_users = {}
+        for items in segment_items:
+            for item in items:
+                tenant_id = item.get('tenant_id')
+                user_email = item.get('user_email')
+                if not tenant_id or not user_email:
+                    continue
+                # Same pick as the Limit=1 query in get_billing_user_for_tenant: lowest user_email wins
+                if tenant_id not in billing_users or user_email < billing_users[tenant_id]:
+                    billing_users[tenant_id] = user_email
+        
+        print(f"Loaded billing users for {len(billing_users)} tenants from {segments} scan segments")
+        return billing_users
+        
+    except Exception as e:
+        print(f"Error loading tenant billing users: {str(e)}")
+        return None
+
+def build_token_debit_update(user_email, tokens_to_debit, operation_type, breakdown=None):
+    """update_item arguments that debit a user's token balance (allows negative balance)
+    
+    breakdown maps item -> tokens (e.g. tenant -> storage tokens) and is stored on the
+    user as last_{operation_type}_debit in the same update, for audit.
+    """
+    update_expression = 'SET token_balance = if_not_exists(token_balance, :zero) - :tokens, last_activity = :activity'
+    expression_values = {
+        ':tokens': Decimal(str(tokens_to_debit)),
+        ':zero': Decimal('0'),
+        ':activity': datetime.utcnow().isoformat()
+    }
+    update = {
+        'Key': {'user_email': user_email},
+        'UpdateExpression': update_expression,
+        'ExpressionAttributeValues': expression_values
+    }
+    if breakdown is not None:
+        update['UpdateExpression'] += ', #breakdown = :breakdown'
+        update['ExpressionAttributeNames'] = {'#breakdown': f"last_{operation_type}_debit"}
+        expression_values[':breakdown'] = {
+            'debited_at': expression_values[':activity'],
+            'tokens': expression_values[':tokens'],
+            'items': {item: Decimal(str(tokens)) for item, tokens in breakdown.items()}
+        }
+    return update
+
+def debit_tokens_from_user(user_email, tokens_to_debit, operation_type, breakdown=None, tenant_id=None):
+    """Debit tokens from a user's account (allows negative balance)
+    
+    With the usage ledger on, the debit is recorded as events (one per breakdown tenant,
+    or one for tenant_id) and reaches token_balance when the ledger is rolled up.
+    """
+    if usage_ledger_enabled:
+        return append_usage_events(user_email, tokens_to_debit, operation_type, breakdown, tenant_id)
+    if token_balance_shards > 0:
+        return debit_token_balance_shard(user_email, tokens_to_debit, operation_type, breakdown)
     try:
         # Update the token balance (allow negative values)
         response = billing_table.update_item(
-            Key={'user_email': user_email},
-            UpdateExpression='SET token_balance = if_not_exists(token_balance, :zero) - :tokens, last_activity = :activity',
-            ExpressionAttributeValues={
-                ':tokens': Decimal(str(tokens_to_debit)),
-                ':zero': Decimal('0'),
-                ':activity': datetime.utcnow().isoformat()
-            },
-            ReturnValues='UPDATED_NEW'
+            ReturnValues='UPDATED_NEW',
+            **build_token_debit_update(user_email, tokens_to_debit, operation_type, breakdown)
         )
         
         new_balance = int(response['Attributes']['token_balance'])
         print(f"Debited {tokens_to_debit} tokens from {user_email} for {operation_type}. New balance: {new_balance}")
+        if breakdown is not None:
+            print(f"{operation_type} debit breakdown for {user_email}: {breakdown}")
         
         return True
         
@@ -2116,31 +3691,696 @@ def debit_tokens_from_user(user_email, tokens_to_debit, operation_type):
         print(f"Error debiting tokens from user {user_email}: {str(e)}")
         return False
 
-def get_all_tenants_from_s3():
-    """Get list of all unique tenant IDs that have schemas in S3"""
+def build_usage_event(tenant_id, event_id, user_email, operation_type, tokens, occurred_at):
+    """A ledger item for one tenant's share of a debit, pending until the rollup applies it"""
+    return {
+        'tenant_id': tenant_id,
+        'event_id': event_id,
+        'user_email': user_email,
+        'operation_type': operation_type,
+        'tokens': Decimal(str(tokens)),
+        'occurred_at': occurred_at,
+        # Sparse index key: present until the rollup has applied the event
+        'pending_shard': f"p{random.randrange(USAGE_LEDGER_PENDING_SHARDS)}"
+    }
+
+def get_usage_event_day(event):
+    """UTC date an event counts toward (events written before occurred_at existed start their ID with it)"""
+    return event.get('occurred_at', event['event_id'])[:10]
+
+def append_usage_events(user_email, tokens_to_debit, operation_type, breakdown=None, tenant_id=None):
+    """Write a debit to the ledger as usage events, one per tenant; True once they are stored
+    
+    breakdown keys are tenant IDs. The events are batch-written before this returns, so an
+    acknowledged debit is never only in memory.
+    """
+    tenant_tokens = breakdown if breakdown is not None else {tenant_id or 'unknown': tokens_to_debit}
+    occurred_at = datetime.utcnow().isoformat()
+    events = [
+        build_usage_event(event_tenant, f"{occurred_at}#{uuid.uuid4().hex[:12]}", user_email, operation_type, tokens, occurred_at)
+        for event_tenant, tokens in tenant_tokens.items() if tokens
+    ]
+    if not events:
+        return True
+    
     try:
-        tenants = []
-        
-        # List all objects with the schemas/ prefix
-        paginator = s3.get_paginator('list_objects_v2')
+        with usage_ledger_table.batch_writer() as batch:
+            for event in events:
+                batch.put_item(Item=event)
+        return True
+    except Exception as e:
+        print(f"Error writing {len(events)} {operation_type} usage events for {user_email}: {str(e)}")
+        return False
+
+def append_keyed_usage_events(event_key, user_email, operation_type, tenant_tokens):
+    """Write a debit's usage events under a caller-chosen key, skipping tenants that already have it
+    
+    Returns how many events were new. Retrying with the same key never adds a second event
+    for a tenant, so the caller can retry a debit whose outcome it never saw.
+    """
+    occurred_at = datetime.utcnow().isoformat()
+    new_events = 0
+    for event_tenant, tokens in tenant_tokens.items():
+        if not tokens:
+            continue
+        try:
+            usage_ledger_table.put_item(
+                Item=build_usage_event(event_tenant, event_key, user_email, operation_type, tokens, occurred_at),
+                ConditionExpression='attribute_not_exists(event_id)'
+            )
+            new_events += 1
+        except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            print(f"Usage event {event_key} for tenant {event_tenant} was already written")
+    return new_events
+
+def apply_usage_rollup(user_email, events):
+    """Fold one batch of a user's usage events into token_balance and the per-tenant daily aggregates
+    
+    Everything goes in one transaction, and each event is marked rolled up on condition it
+    still is pending, so a batch is applied exactly once even if rollups overlap.
+    """
+    now = datetime.utcnow().isoformat()
+    tokens = sum((event['tokens'] for event in events), Decimal('0'))
+    transact_items = [{
+        'Update': {
+            'TableName': billing_table.name,
+            'Key': {'user_email': user_email},
+            'UpdateExpression': 'SET token_balance = if_not_exists(token_balance, :zero) - :tokens, last_activity = :now',
+            'ExpressionAttributeValues': {':tokens': tokens, ':zero': Decimal('0'), ':now': now}
+        }
+    }]
+    
+    # Daily aggregates live in the ledger table under sort key daily#YYYY-MM-DD
+    daily = {}
+    for event in events:
+        operations = daily.setdefault((event['tenant_id'], get_usage_event_day(event)), {})
+        operations[event['operation_type']] = operations.get(event['operation_type'], Decimal('0')) + event['tokens']
+    for (tenant_id, day), operations in daily.items():
+        names = {'#total': 'tokens_total'}
+        values = {':total': sum(operations.values(), Decimal('0'))}
+        additions = ['#total :total']
+        for i, (operation_type, operation_tokens) in enumerate(operations.items()):
+            names[f'#op{i}'] = f"tokens_{operation_type}"
+            values[f':op{i}'] = operation_tokens
+            additions.append(f'#op{i} :op{i}')
+        transact_items.append({
+            'Update': {
+                'TableName': usage_ledger_table.name,
+                'Key': {'tenant_id': tenant_id, 'event_id': f"daily#{day}"},
+                'UpdateExpression': 'ADD ' + ', '.join(additions),
+                'ExpressionAttributeNames': names,
+                'ExpressionAttributeValues': values
+            }
+        })
+    
+    for event in events:
+        transact_items.append({
+            'Update': {
+                'TableName': usage_ledger_table.name,
+                'Key': {'tenant_id': event['tenant_id'], 'event_id': event['event_id']},
+                'UpdateExpression': 'REMOVE pending_shard SET rolled_up_at = :now',
+                'ConditionExpression': 'attribute_exists(pending_shard)',
+                'ExpressionAttributeValues': {':now': now}
+            }
+        })
+    
+    dynamodb.meta.client.transact_write_items(TransactItems=transact_items)
+    return tokens
+
+def chunk_usage_events(events):
+    """Split a user's events into batches whose rollup transaction stays within the item limit"""
+    chunk, days = [], set()
+    for event in events:
+        event_day = (event['tenant_id'], get_usage_event_day(event))
+        # balance update + one aggregate per tenant/day + one update per event
+        needed = 1 + len(days | {event_day}) + len(chunk) + 1
+        if chunk and needed > MAX_TRANSACTION_ITEMS:
+            yield chunk
+            chunk, days = [], set()
+        chunk.append(event)
+        days.add(event_day)
+    if chunk:
+        yield chunk
+
+def rollup_usage_ledger():
+    """Fold all pending usage events into user balances and per-tenant daily aggregates; returns a summary"""
+    events = []
+    for shard in range(USAGE_LEDGER_PENDING_SHARDS):
+        query_kwargs = {
+            'IndexName': 'PendingIndex',
+            'KeyConditionExpression': 'pending_shard = :shard',
+            'ExpressionAttributeValues': {':shard': f"p{shard}"}
+        }
+        while True:
+            response = usage_ledger_table.query(**query_kwargs)
+            events.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    user_events = {}
+    for event in events:
+        user_events.setdefault(event['user_email'], []).append(event)
+    
+    summary = {'users': len(user_events), 'events_rolled_up': 0, 'tokens_rolled_up': 0, 'failed_batches': 0}
+    for user_email, pending in user_events.items():
+        for chunk in chunk_usage_events(sorted(pending, key=lambda event: (get_usage_event_day(event), event['event_id']))):
+            try:
+                summary['tokens_rolled_up'] += int(apply_usage_rollup(user_email, chunk))
+                summary['events_rolled_up'] += len(chunk)
+            except Exception as e:
+                # Usually another rollup got there first; anything left pending is picked up next time
+                print(f"Error rolling up {len(chunk)} usage events for {user_email}: {str(e)}")
+                summary['failed_batches'] += 1
+    
+    print(f"Usage ledger rollup: {summary}")
+    return summary
+
+def get_token_balance_shard_id(user_email, shard):
+    return f"{user_email}#{shard}"
+
+def build_token_balance_shard_update(user_email, tokens_to_debit, operation_type, breakdown=None):
+    """update_item arguments that debit one of a user's counter shards, picked at random"""
+    shard = random.randrange(token_balance_shards)
+    update_expression = 'ADD token_delta :delta SET user_email = :email, last_activity = :activity'
+    expression_values = {
+        ':delta': -Decimal(str(tokens_to_debit)),
+        ':email': user_email,
+        ':activity': datetime.utcnow().isoformat()
+    }
+    update = {
+        'Key': {'shard_id': get_token_balance_shard_id(user_email, shard)},
+        'UpdateExpression': update_expression,
+        'ExpressionAttributeValues': expression_values
+    }
+    if breakdown is not None:
+        update['UpdateExpression'] += ', #breakdown = :breakdown'
+        update['ExpressionAttributeNames'] = {'#breakdown': f"last_{operation_type}_debit"}
+        expression_values[':breakdown'] = {
+            'debited_at': expression_values[':activity'],
+            'tokens': Decimal(str(tokens_to_debit)),
+            'items': {item: Decimal(str(tokens)) for item, tokens in breakdown.items()}
+        }
+    return update
+
+def debit_token_balance_shard(user_email, tokens_to_debit, operation_type, breakdown=None):
+    """Debit a random counter shard instead of the user's billing-admins item, so busy users don't throttle one key"""
+    try:
+        update = build_token_balance_shard_update(user_email, tokens_to_debit, operation_type, breakdown)
+        token_balance_shards_table.update_item(**update)
+        print(f"Debited {tokens_to_debit} tokens from {user_email} (shard {update['Key']['shard_id']}) for {operation_type}")
+        if breakdown is not None:
+            print(f"{operation_type} debit breakdown for {user_email}: {breakdown}")
+        
+        return True
+        
+    except Exception as e:
+        print(f"Error debiting tokens from user {user_email} on a counter shard: {str(e)}")
+        return False
+
+def get_token_balance_shard_deltas(user_email, shard_count=None):
+    """Read a user's unfolded counter shards; returns {shard_id: delta} for the shards that exist"""
+    shard_count = token_balance_shards if shard_count is None else shard_count
+    if shard_count <= 0:
+        return {}
+    
+    deltas = {}
+    request_items = {
+        token_balance_shards_table.name: {
+            'Keys': [{'shard_id': get_token_balance_shard_id(user_email, shard)} for shard in range(shard_count)],
+            'ProjectionExpression': 'shard_id, token_delta'
+        }
+    }
+    while request_items:
+        response = dynamodb.batch_get_item(RequestItems=request_items)
+        for item in response.get('Responses', {}).get(token_balance_shards_table.name, []):
+            deltas[item['shard_id']] = item.get('token_delta', Decimal('0'))
+        request_items = response.get('UnprocessedKeys') or None
+    return deltas
+
+def get_token_balance(user_email, billing_admin):
+    """A user's spendable balance: the billing-admins balance plus whatever the counter shards hold"""
+    token_balance = Decimal(str(billing_admin.get('token_balance', 0)))
+    try:
+        token_balance += sum(get_token_balance_shard_deltas(user_email).values(), Decimal('0'))
+    except Exception as e:
+        print(f"Error reading token balance shards for {user_email}: {str(e)}")
+    return int(math.floor(float(token_balance)))
+
+def compact_token_balance(user_email, deltas):
+    """Fold a user's shard deltas into billing-admins in one transaction; returns the tokens folded
+    
+    Each shard is decremented by exactly the amount read, so debits landing during
+    compaction stay on their shard for the next pass.
+    """
+    deltas = {shard_id: delta for shard_id, delta in deltas.items() if delta}
+    if not deltas:
+        return 0
+    total = sum(deltas.values(), Decimal('0'))
+    now = datetime.utcnow().isoformat()
+    
+    transact_items = [{
+        'Update': {
+            'TableName': billing_table.name,
+            'Key': {'user_email': user_email},
+            'UpdateExpression': 'SET token_balance = if_not_exists(token_balance, :zero) + :total, balance_compacted_at = :now',
+            'ConditionExpression': 'attribute_exists(user_email)',
+            'ExpressionAttributeValues': {':total': total, ':zero': Decimal('0'), ':now': now}
+        }
+    }]
+    for shard_id, delta in deltas.items():
+        transact_items.append({
+            'Update': {
+                'TableName': token_balance_shards_table.name,
+                'Key': {'shard_id': shard_id},
+                'UpdateExpression': 'ADD token_delta :fold',
+                'ExpressionAttributeValues': {':fold': -delta}
+            }
+        })
+    dynamodb.meta.client.transact_write_items(TransactItems=transact_items)
+    return int(total)
+
+def compact_token_balances():
+    """Fold every user's counter shards back into billing-admins; returns a summary"""
+    shard_deltas = {}
+    scan_kwargs = {'ProjectionExpression': 'shard_id, user_email, token_delta'}
+    while True:
+        response = token_balance_shards_table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            if item.get('token_delta'):
+                shard_deltas.setdefault(item['user_email'], {})[item['shard_id']] = item['token_delta']
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    summary = {'users_compacted': 0, 'failed_users': 0, 'tokens_folded': 0}
+    for user_email, deltas in shard_deltas.items():
+        try:
+            summary['tokens_folded'] += compact_token_balance(user_email, deltas)
+            summary['users_compacted'] += 1
+        except Exception as e:
+            print(f"Error compacting token balance for {user_email}: {str(e)}")
+            summary['failed_users'] += 1
+    
+    print(f"Token balance compaction: {summary}")
+    return summary
+
+def is_valid_billing_run_id(run_id):
+    """Run IDs end up in DynamoDB keys; keep them short and plain"""
+    return (isinstance(run_id, str) and 0 < len(run_id) <= 64
+            and all(c in string.ascii_letters + string.digits + '-_.:' for c in run_id))
+
+def load_billing_run(run_id, entry_id=BILLING_RUN_HEADER):
+    """Load a billing run's header (status, checkpoint cursor, results), or None if it never started"""
+    response = billing_runs_table.get_item(Key={'run_id': run_id, 'entry_id': entry_id})
+    return response.get('Item')
+
+def collect_open_billing_runs():
+    """Collect every unfinished fan-out billing run, re-dispatching stalled shards; returns a summary"""
+    summary = {'runs_checked': 0, 'runs_completed': 0, 'runs_in_progress': 0, 'runs_failed': 0}
+    scan_kwargs = {
+        'FilterExpression': 'entry_id = :header AND #status = :in_progress AND attribute_exists(pass_id)',
+        'ExpressionAttributeNames': {'#status': 'status'},
+        'ExpressionAttributeValues': {':header': BILLING_RUN_HEADER, ':in_progress': 'in_progress'}
+    }
+    while True:
+        response = billing_runs_table.scan(**scan_kwargs)
+        for billing_run in response.get('Items', []):
+            summary['runs_checked'] += 1
+            try:
+                collected = collect_billing_shards(billing_run['run_id'], billing_run)
+                if collected['statusCode'] == 200:
+                    summary['runs_completed'] += 1
+                else:
+                    summary['runs_in_progress'] += 1
+            except Exception as e:
+                print(f"Error collecting billing run {billing_run['run_id']}: {str(e)}")
+                summary['runs_failed'] += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    
+    print(f"Billing run collection: {summary}")
+    return summary
+
+def new_billing_debit_results():
+    """Zeroed counters for the debit side of a billing run"""
+    return {
+        'successful_bills': 0,
+        'failed_bills': 0,
+        'already_billed': 0,
+        'billed_users': 0,
+        'total_tokens_billed': 0
+    }
+
+def get_billing_shard(user_email, shard_count):
+    """Stable shard for a billing user; sharding by user keeps each user's debit in a single shard"""
+    return int(hashlib.sha256(user_email.encode('utf-8')).hexdigest(), 16) % shard_count
+
+def get_billing_shard_key(run_id, shard):
+    """S3 key for the users a shard worker has to bill"""
+    return f"billing-runs/{run_id}/shard-{shard}.json"
+
+def dispatch_billing_shard(run_id, pass_id, shard, concurrency):
+    """Start one shard worker without waiting for it; the coordinator reads its result from the shard header later"""
+    dispatch_worker_event({
+        'type': 'bill_shard',
+        'body': {'run_id': run_id, 'pass_id': pass_id, 'shard': shard, 'concurrency': concurrency}
+    })
+
+def dispatch_billing_continuation(body, run_id):
+    """Resume a checkpointed billing run in a new invocation with the same options"""
+    continuation = {
+        key: body[key]
+        for key in ('passkey', 'storage_source', 'inventory_manifest', 'concurrency', 'max_users')
+        if key in body
+    }
+    # The usage report was already written by the invocation that started the run
+    continuation['run_id'] = run_id
+    dispatch_worker_event({'type': 'bill', 'body': continuation})
+
+def coordinate_billing_shards(run_id, billing_run, user_tenant_tokens, pricing_results, shard_count, concurrency, usage_report_key=None):
+    """Split a run's debits into shards by billing user and start a worker per shard
+    
+    Workers are fire-and-forget: each checkpoints to its own shard header, and the
+    collect_billing_runs schedule (or a bill call for the same run_id) collects those
+    headers instead of waiting here.
+    """
+    shard_users = [{} for _ in range(shard_count)]
+    for user_email, tenant_tokens in user_tenant_tokens.items():
+        shard_users[get_billing_shard(user_email, shard_count)][user_email] = tenant_tokens
+    
+    for shard, users in enumerate(shard_users):
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=get_billing_shard_key(run_id, shard),
+            Body=json.dumps({'run_id': run_id, 'shard': shard, 'user_tenant_tokens': users}),
+            ContentType='application/json'
+        )
+    
+    # A pass ID ties shard headers to this dispatch, so headers left by an earlier pass of the run are ignored
+    pass_id = datetime.utcnow().isoformat()
+    billing_run.update({
+        'status': 'in_progress',
+        'pass_id': pass_id,
+        'shard_count': shard_count,
+        'concurrency': concurrency,
+        'shard_users': [len(users) for users in shard_users],
+        'shard_dispatched_at': [pass_id] * shard_count,
+        'pricing_results': pricing_results,
+        'usage_report': usage_report_key,
+        'results': None
+    })
+    save_billing_run(billing_run)
+    
+    print(f"Billing run {run_id}: fanning {len(user_tenant_tokens)} users out to {shard_count} shards")
+    for shard in range(shard_count):
+        try:
+            dispatch_billing_shard(run_id, pass_id, shard, concurrency)
+        except Exception as e:
+            # Collecting the run re-dispatches shards that never started
+            print(f"Error dispatching billing shard {shard} for run {run_id}: {str(e)}")
+    
+    return collect_billing_shards(run_id, billing_run)
+
+def collect_billing_shards(run_id, billing_run):
+    """Merge the shard headers of a fan-out run, re-dispatching shards that stalled; completes the run once all are done"""
+    shard_count = int(billing_run['shard_count'])
+    concurrency = int(billing_run.get('concurrency', billing_concurrency))
+    # Live workers checkpoint after every chunk, so a shard silent for a whole function timeout has no worker
+    stale_before = (datetime.utcnow() - timedelta(seconds=async_job_timeout_seconds)).isoformat()
+    
+    billing_results = new_billing_debit_results()
+    shards = []
+    for shard in range(shard_count):
+        shard_run = load_billing_run(run_id, f"{BILLING_RUN_HEADER}#shard-{shard}")
+        if shard_run and shard_run.get('pass_id') != billing_run['pass_id']:
+            shard_run = None
+        status = shard_run['status'] if shard_run else 'pending'
         
-        for page in paginator.paginate(Bucket=bucket_name, Prefix='schemas/', Delimiter='/'):
-            # CommonPrefixes contains the tenant directories
-            if 'CommonPrefixes' in page:
-                for prefix in page['CommonPrefixes']:
-                    # Extract tenant ID from prefix (e.g., 'schemas/airline/' -> 'airline')
-                    tenant_prefix = prefix['Prefix']
-                    tenant_id = tenant_prefix.replace('schemas/', '').rstrip('/')
-                    if tenant_id:  # Skip empty strings
-                        tenants.append(tenant_id)
+        if status in ('completed', 'completed_with_failures'):
+            for counter, value in shard_run.get('results', {}).items():
+                billing_results[counter] = billing_results.get(counter, 0) + value
+        else:
+            last_seen = max(shard_run['updated_at'] if shard_run else '', billing_run['shard_dispatched_at'][shard])
+            if last_seen < stale_before:
+                print(f"Billing run {run_id} shard {shard} has stalled - dispatching it again")
+                billing_run['shard_dispatched_at'][shard] = datetime.utcnow().isoformat()
+                try:
+                    dispatch_billing_shard(run_id, billing_run['pass_id'], shard, concurrency)
+                except Exception as e:
+                    print(f"Error re-dispatching billing shard {shard} for run {run_id}: {str(e)}")
         
-        return tenants
+        shards.append({'shard': shard, 'status': status, 'users': int(billing_run['shard_users'][shard])})
+    
+    shard_statuses = [shard_summary['status'] for shard_summary in shards]
+    if all(status == 'completed' for status in shard_statuses):
+        status = 'completed'
+    elif all(status in ('completed', 'completed_with_failures') for status in shard_statuses):
+        status = 'completed_with_failures'
+    else:
+        status = 'in_progress'
+    
+    billing_run['status'] = status
+    if status != 'in_progress':
+        for counter, value in billing_run.get('pricing_results', {}).items():
+            billing_results[counter] = billing_results.get(counter, 0) + value
+        billing_run['results'] = billing_results
+        billing_run['completed_at'] = datetime.utcnow().isoformat()
+        print(f"Billing run {run_id} {status} across {shard_count} shards")
+        print(f"Billing results: {billing_results}")
+    save_billing_run(billing_run)
+    
+    response_body = {
+        'message': 'Daily storage billing completed successfully' if status != 'in_progress' else f'Billing run {run_id} shards are still running; the collect_billing_runs schedule will collect them',
+        'run_id': run_id,
+        'status': status,
+        'results': billing_results,
+        'shards': shards
+    }
+    if billing_run.get('usage_report'):
+        response_body['usage_report'] = billing_run['usage_report']
+    
+    return create_response(202 if status == 'in_progress' else 200, response_body)
+
+def handle_bill_shard(body, context=None):
+    """Worker side of a fan-out billing run: bill the users assigned to one shard, resuming from its checkpoint"""
+    run_id = body.get('run_id')
+    pass_id = body.get('pass_id')
+    shard = body.get('shard')
+    if not is_valid_billing_run_id(run_id) or not isinstance(shard, int) or not 0 <= shard < BILLING_MAX_SHARDS:
+        return create_response(400, {'error': 'run_id and shard are required'})
+    if not isinstance(pass_id, str) or not pass_id:
+        return create_response(400, {'error': 'pass_id is required'})
+    
+    concurrency = body.get('concurrency', billing_concurrency)
+    if not isinstance(concurrency, int) or concurrency < 1:
+        concurrency = billing_concurrency
+    concurrency = min(concurrency, BILLING_MAX_CONCURRENCY)
+    
+    try:
+        assignment = json.loads(s3.get_object(
+            Bucket=bucket_name,
+            Key=get_billing_shard_key(run_id, shard)
+        )['Body'].read().decode('utf-8'))
+        user_tenant_tokens = assignment['user_tenant_tokens']
+        
+        # Each shard keeps its own checkpoint; debit records stay per run, so shards and reruns can't double-bill
+        entry_id = f"{BILLING_RUN_HEADER}#shard-{shard}"
+        shard_run = load_billing_run(run_id, entry_id)
+        if shard_run and shard_run.get('pass_id') != pass_id:
+            shard_run = None
+        if shard_run and shard_run.get('status') in ('completed', 'completed_with_failures'):
+            return create_response(200, {
+                'run_id': run_id,
+                'shard': shard,
+                'status': shard_run['status'],
+                'results': shard_run.get('results', {})
+            })
+        
+        if not shard_run:
+            shard_run = {
+                'run_id': run_id,
+                'entry_id': entry_id,
+                'pass_id': pass_id,
+                'status': 'in_progress',
+                'started_at': datetime.utcnow().isoformat(),
+                'cursor': None,
+                'failed_users': 0,
+                'results': new_billing_debit_results()
+            }
+            # Visible to the coordinator before the first chunk lands
+            save_billing_run(shard_run)
+        
+        remaining_users = process_billing_debits(
+            run_id, shard_run, user_tenant_tokens, shard_run['results'], concurrency, context
+        )
+        print(f"Billing run {run_id} shard {shard} {shard_run['status']}: {remaining_users} users remaining")
+        
+        if remaining_users:
+            # Out of time: carry on in a fresh invocation from the checkpoint just saved
+            dispatch_billing_shard(run_id, pass_id, shard, concurrency)
+        
+        response_body = {
+            'run_id': run_id,
+            'shard': shard,
+            'status': shard_run['status'],
+            'results': shard_run['results']
+        }
+        if remaining_users:
+            response_body['remaining_users'] = remaining_users
+        return create_response(202 if remaining_users else 200, response_body)
         
     except Exception as e:
-        print(f"Error getting tenants from S3: {str(e)}")
-        return []
+        print(f"Error in billing shard {shard} for run {run_id}: {str(e)}")
+        return create_response(500, {'error': f'Failed to process billing shard {shard}'})
+
+def save_billing_run(billing_run):
+    """Write a billing run's header; this is the checkpoint a later invocation resumes from"""
+    billing_run['updated_at'] = datetime.utcnow().isoformat()
+    billing_run['expires_at'] = int((datetime.utcnow() + timedelta(days=BILLING_RUN_RETENTION_DAYS)).timestamp())
+    billing_runs_table.put_item(Item=billing_run)
 
-def handle_bill(body):
+def debit_storage_for_run(run_id, user_email, tenant_tokens):
+    """Debit a user's storage tokens at most once per run; returns 'debited', 'already_billed' or 'failed'
+    
+    The debit record and the balance update go in one transaction, and the record is
+    conditional on not existing yet, so retries and resumed runs cannot bill twice.
+    With the usage ledger on, the debit becomes one ledger event per tenant keyed by the run instead.
+    """
+    tokens = sum(tenant_tokens.values())
+    debit_record = {
+        'run_id': run_id,
+        'entry_id': f"debit#{user_email}",
+        'user_email': user_email,
+        'tokens': tokens,
+        'tenants': tenant_tokens,
+        'debited_at': datetime.utcnow().isoformat(),
+        'expires_at': int((datetime.utcnow() + timedelta(days=BILLING_RUN_RETENTION_DAYS)).timestamp())
+    }
+    
+    if usage_ledger_enabled:
+        try:
+            new_events = append_keyed_usage_events(f"storage#{run_id}", user_email, 'storage', tenant_tokens)
+            # Written once the events are, for the same audit trail as the direct debit
+            billing_runs_table.put_item(Item=debit_record)
+        except Exception as e:
+            print(f"Error writing storage usage events for {user_email} in run {run_id}: {str(e)}")
+            return 'failed'
+        if not new_events:
+            print(f"{user_email} was already billed in run {run_id} - skipping")
+            return 'already_billed'
+        print(f"Recorded {tokens} storage tokens for {user_email} in run {run_id} as usage events: {tenant_tokens}")
+        return 'debited'
+    
+    debit_update = build_token_debit_update(user_email, tokens, 'storage', tenant_tokens)
+    debit_update['TableName'] = billing_table.name
+    try:
+        dynamodb.meta.client.transact_write_items(TransactItems=[
+            {
+                'Put': {
+                    'TableName': billing_runs_table.name,
+                    'Item': debit_record,
+                    'ConditionExpression': 'attribute_not_exists(entry_id)'
+                }
+            },
+            {'Update': debit_update}
+        ])
+        print(f"Debited {tokens} storage tokens from {user_email} for run {run_id}: {tenant_tokens}")
+        return 'debited'
+        
+    except dynamodb.meta.client.exceptions.TransactionCanceledException as e:
+        reasons = e.response.get('CancellationReasons', [])
+        if reasons and reasons[0].get('Code') == 'ConditionalCheckFailed':
+            print(f"{user_email} was already billed in run {run_id} - skipping")
+            return 'already_billed'
+        print(f"Storage debit for {user_email} in run {run_id} was cancelled: {reasons}")
+        return 'failed'
+    except Exception as e:
+        print(f"Error debiting storage tokens from {user_email} for run {run_id}: {str(e)}")
+        return 'failed'
+
+def process_billing_debits(run_id, billing_run, user_tenant_tokens, billing_results, concurrency, context=None, max_users=None):
+    """Debit the users after billing_run's checkpoint in chunks, checkpointing after each; returns users still pending
+    
+    Stops early when the Lambda is close to its deadline or max_users have been handled.
+    Debit counters are added to billing_results, which the caller keeps on the run header.
+    """
+    # Users are processed in a stable order so the checkpoint is just the last user handled
+    pending_users = sorted(u for u in user_tenant_tokens if billing_run['cursor'] is None or u > billing_run['cursor'])
+    if max_users is not None:
+        pending_users = pending_users[:max_users]
+    
+    processed_users = 0
+    while processed_users < len(pending_users):
+        if context is not None and context.get_remaining_time_in_millis() < BILLING_RUN_TIME_MARGIN_MS:
+            print(f"Billing run {run_id} is running out of time - checkpointing")
+            break
+        
+        chunk = pending_users[processed_users:processed_users + concurrency]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            debit_statuses = list(executor.map(
+                lambda user_email: debit_storage_for_run(run_id, user_email, user_tenant_tokens[user_email]),
+                chunk
+            ))
+        
+        for user_email, debit_status in zip(chunk, debit_statuses):
+            tenant_tokens = user_tenant_tokens[user_email]
+            if debit_status == 'debited':
+                billing_results['successful_bills'] += len(tenant_tokens)
+                billing_results['total_tokens_billed'] += sum(tenant_tokens.values())
+                billing_results['billed_users'] += 1
+            elif debit_status == 'already_billed':
+                billing_results['already_billed'] += len(tenant_tokens)
+            else:
+                billing_results['failed_bills'] += len(tenant_tokens)
+                billing_run['failed_users'] += 1
+        
+        processed_users += len(chunk)
+        billing_run['cursor'] = chunk[-1]
+        billing_run['status'] = 'in_progress'
+        save_billing_run(billing_run)
+    
+    remaining_users = sum(1 for u in user_tenant_tokens if billing_run['cursor'] is None or u > billing_run['cursor'])
+    if remaining_users:
+        billing_run['status'] = 'in_progress'
+    else:
+        billing_run['status'] = 'completed_with_failures' if billing_run['failed_users'] else 'completed'
+        billing_run['completed_at'] = datetime.utcnow().isoformat()
+    save_billing_run(billing_run)
+    return remaining_users
+
+def price_tenant_storage(tenant_id, storage_usage_mb, billing_users=None):
+    """Work out one tenant's storage tokens and who pays them; returns {'tenant_id', 'status', 'tokens', 'user_email'}"""
+    try:
+        print(f"Processing storage billing for tenant: {tenant_id}")
+        
+        # Find the billing user for this tenant, from the run's bulk map when there is one
+        if billing_users is not None:
+            billing_user_email = billing_users.get(tenant_id)
+        else:
+            billing_user_email = get_billing_user_for_tenant(tenant_id)
+        
+        if not billing_user_email:
+            print(f"No billing user found for tenant {tenant_id} - skipping")
+            return {'tenant_id': tenant_id, 'status': 'no_billing_user', 'tokens': 0, 'user_email': None}
+        
+        print(f"Storage usage for {tenant_id}: {storage_usage_mb} MB (billing user: {billing_user_email})")
+        
+        # Calculate tokens to debit (1 token per 10MB, minimum 1 token if they have any storage)
+        storage_tokens = max(1, storage_usage_mb // 10) if storage_usage_mb > 0 else 0
+        
+        if storage_tokens == 0:
+            print(f"No storage usage for tenant {tenant_id} - skipping billing")
+            return {'tenant_id': tenant_id, 'status': 'no_usage', 'tokens': 0, 'user_email': billing_user_email}
+        
+        return {'tenant_id': tenant_id, 'status': 'due', 'tokens': storage_tokens, 'user_email': billing_user_email}
+        
+    except Exception as e:
+        print(f"Error pricing storage for tenant {tenant_id}: {str(e)}")
+        return {'tenant_id': tenant_id, 'status': 'failed', 'tokens': 0, 'user_email': None}
+
+def handle_bill(body, context=None):
     """Handle daily storage billing process"""
     try:
         print("Starting daily storage billing process...")
@@ -2167,84 +4407,447 @@ def handle_bill(body):
         
         print("✅ Billing passkey verified successfully")
         
-        # Get list of all tenants with schemas in S3
-        tenants = get_all_tenants_from_s3()
-        print(f"Found {len(tenants)} tenants with schemas in S3")
+        if body.get('mode') == 'reconcile_storage':
+            reconciliation = reconcile_storage_counters(fix=body.get('fix') is True)
+            if reconciliation is None:
+                return create_response(500, {'error': 'Failed to reconcile storage counters'})
+            return create_response(200, {
+                'message': 'Storage counter reconciliation completed',
+                'results': reconciliation
+            })
+        
+        if body.get('mode') == 'rollup_usage':
+            return create_response(200, {
+                'message': 'Usage ledger rollup completed',
+                'results': rollup_usage_ledger()
+            })
+        
+        if body.get('mode') == 'retry_stripe_events':
+            return create_response(200, {
+                'message': 'Stripe event retry completed',
+                'results': retry_stripe_events()
+            })
+        
+        if body.get('mode') == 'refresh_stripe_accounts':
+            return create_response(200, {
+                'message': 'Stripe account status refresh completed',
+                'results': refresh_pending_stripe_accounts(body.get('concurrency'))
+            })
+        
+        if body.get('mode') == 'compact_balances':
+            return create_response(200, {
+                'message': 'Token balance compaction completed',
+                'results': compact_token_balances()
+            })
+        
+        if body.get('mode') == 'collect_billing_runs':
+            return create_response(200, {
+                'message': 'Fan-out billing run collection completed',
+                'results': collect_open_billing_runs()
+            })
+        
+        # Runs are keyed by ID (the UTC date by default) so a rerun never bills a user twice
+        run_id = body.get('run_id') or datetime.utcnow().strftime('%Y-%m-%d')
+        if not is_valid_billing_run_id(run_id):
+            return create_response(400, {'error': 'run_id must be 1-64 letters, digits, or - _ . :'})
+        
+        max_users = body.get('max_users')
+        if max_users is not None and (not isinstance(max_users, int) or max_users < 1):
+            return create_response(400, {'error': 'max_users must be a positive integer'})
+        
+        # Fan-out mode runs the debits as shard workers, split by billing user
+        fan_out = body.get('mode') == 'fan_out'
+        shard_count = body.get('shards', billing_default_shards)
+        if fan_out and (not isinstance(shard_count, int) or not 1 <= shard_count <= BILLING_MAX_SHARDS):
+            return create_response(400, {'error': f'shards must be an integer from 1 to {BILLING_MAX_SHARDS}'})
+        
+        billing_run = load_billing_run(run_id)
+        if billing_run and billing_run.get('status') == 'completed':
+            print(f"Billing run {run_id} already completed - nothing to do")
+            return create_response(200, {
+                'message': f'Billing run {run_id} already completed',
+                'run_id': run_id,
+                'status': 'completed',
+                'results': billing_run.get('results', {})
+            })
+        
+        # Resume from the checkpoint of an unfinished run; a finished run with failures starts a retry pass
+        resuming = bool(billing_run) and billing_run.get('status') == 'in_progress'
+        if resuming and billing_run.get('pass_id'):
+            # Shards of a fan-out run are already assigned and running; just collect what they've done
+            return collect_billing_shards(run_id, billing_run)
+        if not resuming:
+            billing_run = {
+                'run_id': run_id,
+                'entry_id': BILLING_RUN_HEADER,
+                'started_at': datetime.utcnow().isoformat(),
+                'cursor': None,
+                'failed_users': 0,
+                'results': None
+            }
         
-        billing_results = {
-            'processed_tenants': 0,
-            'successful_bills': 0,
-            'failed_bills': 0,
-            'no_billing_user': 0,
-            'total_tokens_billed': 0
+        # Size every tenant up front so the per-tenant work needs no further listing
+        storage_source = body.get('storage_source', 'listing')
+        if storage_source not in STORAGE_SOURCES:
+            return create_response(400, {'error': f"storage_source must be one of {STORAGE_SOURCES}"})
+        
+        inventory_manifest = body.get('inventory_manifest')
+        if storage_source == 'inventory':
+            # Only S3 locations here; local manifests are for calling scan_inventory_storage_bytes directly
+            if not isinstance(inventory_manifest, str) or not inventory_manifest:
+                return create_response(400, {'error': 'inventory_manifest is required when storage_source is inventory'})
+            if not inventory_manifest.startswith('s3://'):
+                inventory_manifest = f"s3://{bucket_name}/{inventory_manifest.lstrip('/')}"
+        
+        storage_bytes = get_tenant_storage_bytes(storage_source, inventory_manifest)
+        if storage_bytes is None:
+            return create_response(500, {'error': f"Failed to read storage usage from {storage_source}"})
+        
+        tenants = sorted(storage_bytes)
+        print(f"Found {len(tenants)} tenants with schemas in S3 (source: {storage_source})")
+        
+        usage_report_key = None
+        if body.get('usage_report'):
+            usage_report_key = write_storage_usage_report(storage_bytes, storage_source)
+        
+        # Bounds the per-tenant lookups and the debits that follow
+        concurrency = body.get('concurrency', billing_concurrency)
+        if not isinstance(concurrency, int) or concurrency < 1:
+            return create_response(400, {'error': 'concurrency must be a positive integer'})
+        concurrency = min(concurrency, BILLING_MAX_CONCURRENCY)
+        print(f"Billing run {run_id}: {len(tenants)} tenants with concurrency {concurrency}" + (f", resuming after {billing_run['cursor']}" if resuming else ""))
+        
+        # One bulk read of the mapping instead of a query per tenant; fall back to queries if it fails
+        billing_users = load_tenant_billing_users()
+        
+        def price(tenant_id):
+            return price_tenant_storage(tenant_id, bytes_to_storage_mb(storage_bytes[tenant_id]), billing_users)
+        
+        if billing_users is not None:
+            # Pricing is only dictionary lookups now, so a thread pool would be pure overhead
+            outcomes = [price(tenant_id) for tenant_id in tenants]
+        else:
+            # Each tenant needs its own billing user query; keep those on the bounded pool
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                outcomes = list(executor.map(price, tenants))
+        
+        # Roll tenants up per billing user so each billing-admins item takes one debit, not one per tenant
+        user_tenant_tokens = {}
+        for outcome in outcomes:
+            if outcome['status'] == 'due':
+                user_tenant_tokens.setdefault(outcome['user_email'], {})[outcome['tenant_id']] = outcome['tokens']
+        
+        pricing_results = {
+            'processed_tenants': len(outcomes),
+            'failed_bills': sum(1 for outcome in outcomes if outcome['status'] == 'failed'),
+            'no_billing_user': sum(1 for outcome in outcomes if outcome['status'] == 'no_billing_user')
         }
         
-        # Process each tenant
-        for tenant_id in tenants:
-            print(f"Processing storage billing for tenant: {tenant_id}")
-            billing_results['processed_tenants'] += 1
-            
-            # Find the billing user for this tenant
-            billing_user_email = get_billing_user_for_tenant(tenant_id)
-            
-            if not billing_user_email:
-                print(f"No billing user found for tenant {tenant_id} - skipping")
-                billing_results['no_billing_user'] += 1
-                continue
-            
-            print(f"Found billing user {billing_user_email} for tenant {tenant_id}")
-            
-            # Calculate storage usage
-            storage_usage_mb = calculate_storage_usage(tenant_id)
-            print(f"Storage usage for {tenant_id}: {storage_usage_mb} MB")
-            
-            # Calculate tokens to debit (1 token per 10MB, minimum 1 token if they have any storage)
-            storage_tokens = max(1, storage_usage_mb // 10) if storage_usage_mb > 0 else 0
-            
-            # Debit tokens from the billing user
-            if storage_tokens > 0:
-                debit_success = debit_tokens_from_user(billing_user_email, storage_tokens, 'storage')
-                if debit_success:
-                    print(f"Debited {storage_tokens} storage tokens for tenant {tenant_id} (user: {billing_user_email})")
-                    billing_results['successful_bills'] += 1
-                    billing_results['total_tokens_billed'] += storage_tokens
-                else:
-                    print(f"Failed to debit tokens for tenant {tenant_id}")
-                    billing_results['failed_bills'] += 1
-            else:
-                print(f"No storage usage for tenant {tenant_id} - skipping billing")
+        if fan_out:
+            return coordinate_billing_shards(
+                run_id, billing_run, user_tenant_tokens, pricing_results, shard_count, concurrency, usage_report_key
+            )
+        
+        billing_results = billing_run['results']
+        if billing_results is None:
+            # Tenant-level counts are taken once, when a pass starts; debits add to them as users are processed
+            billing_results = new_billing_debit_results()
+            billing_results.update(pricing_results)
+            billing_run['results'] = billing_results
         
-        print("Daily storage billing process completed")
+        remaining_users = process_billing_debits(
+            run_id, billing_run, user_tenant_tokens, billing_results, concurrency, context, max_users
+        )
+        
+        print(f"Billing run {run_id} {billing_run['status']}: {remaining_users} users remaining")
         print(f"Billing results: {billing_results}")
         
-        return create_response(200, {
-            'message': 'Daily storage billing completed successfully',
+        if remaining_users:
+            # Out of time or at max_users: carry on in a fresh invocation from the checkpoint just saved
+            try:
+                dispatch_billing_continuation(body, run_id)
+            except Exception as e:
+                print(f"Error dispatching continuation of billing run {run_id}: {str(e)}")
+        
+        response_body = {
+            'message': 'Daily storage billing completed successfully' if not remaining_users else f'Billing run {run_id} checkpointed; resuming in a new invocation',
+            'run_id': run_id,
+            'status': billing_run['status'],
             'results': billing_results
-        })
+        }
+        if remaining_users:
+            response_body['remaining_users'] = remaining_users
+        if usage_report_key:
+            response_body['usage_report'] = usage_report_key
+        
+        return create_response(202 if remaining_users else 200, response_body)
         
     except Exception as e:
         print(f"Error in daily storage billing: {str(e)}")
         return create_response(500, {'error': 'Failed to process daily storage billing'})
 
 
-def calculate_storage_usage(tenant_id):
-    """Calculate storage usage in MB for a tenant"""
+def bytes_to_storage_mb(total_size):
+    """Convert a byte count to whole MB, rounding up"""
+    size_mb = (total_size / (1024 * 1024))
+    return int(size_mb) + (1 if size_mb % 1 > 0 else 0)
+
+def scan_tenant_storage_bytes():
+    """Sum object sizes per tenant in one paginated pass over schemas/; returns {tenant_id: bytes} or None"""
     try:
-        # List all objects in the tenant's schema folder
-        prefix = f"schemas/{tenant_id}/"
-        
-        total_size = 0
+        storage_bytes = {}
+        objects_scanned = 0
         paginator = s3.get_paginator('list_objects_v2')
         
-        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    total_size += obj['Size']
+        for page in paginator.paginate(Bucket=bucket_name, Prefix='schemas/'):
+            for obj in page.get('Contents', []):
+                # schemas/{tenant}/... - objects directly under schemas/ belong to no tenant
+                parts = obj['Key'].split('/', 2)
+                if len(parts) < 3 or not parts[1]:
+                    continue
+                storage_bytes[parts[1]] = storage_bytes.get(parts[1], 0) + obj['Size']
+                objects_scanned += 1
+        
+        print(f"Scanned {objects_scanned} objects across {len(storage_bytes)} tenants")
+        return storage_bytes
+        
+    except Exception as e:
+        print(f"Error scanning tenant storage: {str(e)}")
+        return None
+
+def get_tenant_storage_bytes(storage_source, inventory_manifest=None):
+    """Per-tenant storage in bytes from the given source; None if it could not be read"""
+    if storage_source == 'listing':
+        return scan_tenant_storage_bytes()
+    if storage_source == 'counters':
+        return scan_storage_counters()
+    if storage_source == 'inventory':
+        return scan_inventory_storage_bytes(inventory_manifest)
+    return None
+
+def add_inventory_object(storage_bytes, key, size):
+    """Count one inventory row toward its tenant if it lives under schemas/{tenant}/"""
+    parts = key.split('/', 2)
+    if len(parts) < 3 or parts[0] != 'schemas' or not parts[1] or size in (None, ''):
+        return
+    storage_bytes[parts[1]] = storage_bytes.get(parts[1], 0) + int(size)
+
+def open_inventory_file(location):
+    """Open an inventory manifest or data file as a binary stream; location is s3://bucket/key or a local path"""
+    if location.startswith('s3://'):
+        inventory_bucket, _, key = location[len('s3://'):].partition('/')
+        return s3.get_object(Bucket=inventory_bucket, Key=key)['Body']
+    return open(location, 'rb')
+
+def get_inventory_file_location(manifest_location, manifest, file_key):
+    """Resolve a data file listed in a manifest to a location open_inventory_file understands"""
+    if manifest_location.startswith('s3://'):
+        # destinationBucket is an ARN: arn:aws:s3:::bucket-name
+        destination_bucket = manifest.get('destinationBucket', '').split(':::')[-1]
+        if not destination_bucket:
+            destination_bucket = manifest_location[len('s3://'):].partition('/')[0]
+        return f"s3://{destination_bucket}/{file_key}"
+    # Locally generated reports keep their data files next to the manifest
+    return file_key if os.path.isabs(file_key) else os.path.join(os.path.dirname(manifest_location), file_key)
+
+def scan_inventory_csv(stream, columns, storage_bytes):
+    """Stream one gzipped CSV inventory file row by row into storage_bytes"""
+    key_index = columns.index('key')
+    size_index = columns.index('size')
+    # Versioned inventories list every version; only current, non-deleted objects take up billable space
+    latest_index = columns.index('islatest') if 'islatest' in columns else None
+    delete_marker_index = columns.index('isdeletemarker') if 'isdeletemarker' in columns else None
+    
+    with gzip.GzipFile(fileobj=stream) as gz:
+        for row in csv.reader(io.TextIOWrapper(gz, encoding='utf-8', newline='')):
+            if latest_index is not None and row[latest_index].lower() == 'false':
+                continue
+            if delete_marker_index is not None and row[delete_marker_index].lower() == 'true':
+                continue
+            # CSV inventory keys are URL-encoded
+            add_inventory_object(storage_bytes, urllib.parse.unquote_plus(row[key_index]), row[size_index])
+
+def scan_inventory_parquet(stream, storage_bytes):
+    """Stream one Parquet inventory file in record batches into storage_bytes"""
+    if pq is None:
+        raise RuntimeError('pyarrow is required to read Parquet inventory reports')
+    
+    # Parquet needs a seekable file, so spool to disk rather than into memory
+    with tempfile.TemporaryFile() as spool:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            spool.write(chunk)
+        spool.seek(0)
         
-        # Convert to MB and round up
-        size_mb = (total_size / (1024 * 1024))
-        return int(size_mb) + (1 if size_mb % 1 > 0 else 0)
+        parquet_file = pq.ParquetFile(spool)
+        available = set(parquet_file.schema_arrow.names)
+        columns = [c for c in ('key', 'size', 'is_latest', 'is_delete_marker') if c in available]
+        for batch in parquet_file.iter_batches(columns=columns):
+            rows = batch.to_pydict()
+            for i, key in enumerate(rows['key']):
+                if 'is_latest' in rows and rows['is_latest'][i] is False:
+                    continue
+                if 'is_delete_marker' in rows and rows['is_delete_marker'][i]:
+                    continue
+                add_inventory_object(storage_bytes, key, rows['size'][i])
+
+def scan_inventory_storage_bytes(manifest_location):
+    """Sum object sizes per tenant from an S3 Inventory report; returns {tenant_id: bytes} or None"""
+    try:
+        with contextlib.closing(open_inventory_file(manifest_location)) as manifest_stream:
+            manifest = json.loads(manifest_stream.read())
+        
+        file_format = manifest.get('fileFormat', 'CSV').upper()
+        if file_format not in ('CSV', 'PARQUET'):
+            raise ValueError(f"Unsupported inventory format {manifest.get('fileFormat')}")
+        
+        # CSV rows have no header; fileSchema gives the column order, e.g. "Bucket, Key, Size"
+        columns = [c.strip().lower() for c in manifest.get('fileSchema', '').split(',')]
+        if file_format == 'CSV' and ('key' not in columns or 'size' not in columns):
+            raise ValueError('Inventory report must include the Key and Size fields')
+        
+        storage_bytes = {}
+        for data_file in manifest.get('files', []):
+            location = get_inventory_file_location(manifest_location, manifest, data_file['key'])
+            with contextlib.closing(open_inventory_file(location)) as stream:
+                if file_format == 'CSV':
+                    scan_inventory_csv(stream, columns, storage_bytes)
+                else:
+                    scan_inventory_parquet(stream, storage_bytes)
+        
+        print(f"Read {len(manifest.get('files', []))} inventory files across {len(storage_bytes)} tenants")
+        return storage_bytes
+        
+    except Exception as e:
+        print(f"Error reading inventory report {manifest_location}: {str(e)}")
+        return None
+
+def write_storage_usage_report(storage_bytes, storage_source):
+    """Write a per-tenant storage usage report to S3; returns the report key or None"""
+    try:
+        generated_at = datetime.utcnow()
+        report_key = f"{STORAGE_USAGE_REPORT_PREFIX}{generated_at.strftime('%Y-%m-%d')}.json"
+        report = {
+            'generated_at': generated_at.isoformat(),
+            'storage_source': storage_source,
+            'total_bytes': sum(storage_bytes.values()),
+            'tenants': {
+                tenant_id: {'bytes': size, 'mb': bytes_to_storage_mb(size)}
+                for tenant_id, size in sorted(storage_bytes.items())
+            }
+        }
+        s3.put_object(
+            Bucket=bucket_name,
+            Key=report_key,
+            Body=json.dumps(report, indent=2),
+            ContentType='application/json'
+        )
+        print(f"Wrote storage usage report to {report_key}")
+        return report_key
         
     except Exception as e:
-        print(f"Error calculating storage usage for {tenant_id}: {str(e)}")
+        print(f"Error writing storage usage report: {str(e)}")
+        return None
+
+
+def get_object_size(key):
+    """Size in bytes of an S3 object, 0 if it does not exist"""
+    try:
+        return s3.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            print(f"Error reading size of {key}: {str(e)}")
         return 0
+
+def adjust_storage_counter(tenant_id, delta_bytes):
+    """Atomically add delta_bytes to a tenant's storage counter; failures are logged, never raised"""
+    if not delta_bytes:
+        return
+    try:
+        storage_usage_table.update_item(
+            Key={'tenant_id': tenant_id},
+            UpdateExpression='ADD storage_bytes :delta SET updated_at = :now',
+            ExpressionAttributeValues={
+                ':delta': delta_bytes,
+                ':now': datetime.utcnow().isoformat()
+            }
+        )
+    except Exception as e:
+        print(f"Error adjusting storage counter for {tenant_id} by {delta_bytes}: {str(e)}")
+
+def put_tenant_object(tenant_id, key, body, **put_kwargs):
+    """Write an object under a tenant's prefix and keep its storage counter in step"""
+    previous_size = get_object_size(key)
+    response = s3.put_object(Bucket=bucket_name, Key=key, Body=body, **put_kwargs)
+    size = len(body.encode('utf-8') if isinstance(body, str) else body)
+    adjust_storage_counter(tenant_id, size - previous_size)
+    return response
+
+def delete_tenant_object(tenant_id, key):
+    """Delete an object under a tenant's prefix and keep its storage counter in step"""
+    previous_size = get_object_size(key)
+    response = s3.delete_object(Bucket=bucket_name, Key=key)
+    adjust_storage_counter(tenant_id, -previous_size)
+    return response
+
+def scan_storage_counters():
+    """Read every tenant's storage counter; returns {tenant_id: bytes} or None"""
+    try:
+        storage_bytes = {}
+        scan_kwargs = {'ProjectionExpression': 'tenant_id, storage_bytes'}
+        while True:
+            response = storage_usage_table.scan(**scan_kwargs)
+            for item in response.get('Items', []):
+                storage_bytes[item['tenant_id']] = int(item.get('storage_bytes', 0))
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        
+        print(f"Read storage counters for {len(storage_bytes)} tenants")
+        return storage_bytes
+        
+    except Exception as e:
+        print(f"Error reading storage counters: {str(e)}")
+        return None
+
+def reconcile_storage_counters(fix=False):
+    """Compare storage counters against a real listing, optionally overwriting the ones that drifted"""
+    actual_bytes = scan_tenant_storage_bytes()
+    counter_bytes = scan_storage_counters()
+    if actual_bytes is None or counter_bytes is None:
+        return None
+    
+    mismatches = []
+    for tenant_id in sorted(set(actual_bytes) | set(counter_bytes)):
+        actual = actual_bytes.get(tenant_id, 0)
+        counted = counter_bytes.get(tenant_id, 0)
+        if actual != counted:
+            mismatches.append({'tenant_id': tenant_id, 'counter_bytes': counted, 'actual_bytes': actual})
+    
+    fixed = 0
+    if fix:
+        # Writes landing between the listing and this SET are lost; rerun to converge
+        for mismatch in mismatches:
+            try:
+                storage_usage_table.update_item(
+                    Key={'tenant_id': mismatch['tenant_id']},
+                    UpdateExpression='SET storage_bytes = :actual, updated_at = :now, reconciled_at = :now',
+                    ExpressionAttributeValues={
+                        ':actual': mismatch['actual_bytes'],
+                        ':now': datetime.utcnow().isoformat()
+                    }
+                )
+                fixed += 1
+            except Exception as e:
+                print(f"Error fixing storage counter for {mismatch['tenant_id']}: {str(e)}")
+    
+    print(f"Storage reconciliation: {len(mismatches)} mismatched tenants, {fixed} fixed")
+    return {
+        'tenants_checked': len(set(actual_bytes) | set(counter_bytes)),
+        'mismatches': mismatches,
+        'fixed': fixed
+    }
+
+
+if __name__ == '__main__':
+    # Local streaming adapter: python lambda_function.py
+    run_llm_preload_stream_server(port=int(os.environ.get('LLM_STREAM_PORT', '8081')))
@@ -46,6 +46,14 @@ if (typeof window !== 'undefined') {
             return `${this.API_BASE_URL}/llm-preload`;
         },
         
+        get LLM_PRELOAD_BATCH_URL() {
+            return `${this.API_BASE_URL}/llm-preload-batch`;
+        },
+        
+        get JOB_STATUS_URL() {
+            return `${this.API_BASE_URL}/job_status`;
+        },
+        
         get JSON_URL() {
             return `${this.API_BASE_URL}/json`;
         },
@@ -0,0 +1,254 @@
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+# lambda_function reads these at import time; no AWS call is made until a client is used
+os.environ.setdefault('BUCKET_NAME', 'test-bucket')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lambda_function  # noqa: E402
+
+
+class FakeBody:
+    def __init__(self, data):
+        self._data = data
+        self._stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def iter_lines(self):
+        yield from self._data.splitlines()
+
+    def close(self):
+        pass
+
+
+class FakeS3:
+    """In-memory stand-in for the S3 client calls lambda_function makes"""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        self.objects[Key] = (Body, datetime.utcnow())
+        return {'ETag': f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        data, last_modified = self.objects[Key]
+        return {
+            'Body': FakeBody(data),
+            'ContentLength': len(data),
+            'ETag': f'"{hashlib.md5(data).hexdigest()}"',
+            'LastModified': last_modified
+        }
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        contents = [
+            {'Key': key, 'Size': len(data), 'ETag': f'"{hashlib.md5(data).hexdigest()}"', 'LastModified': last_modified}
+            for key, (data, last_modified) in sorted(self.objects.items())
+            if key.startswith(Prefix)
+        ]
+        return {'Contents': contents} if contents else {}
+
+    def get_paginator(self, operation_name):
+        fake = self
+
+        class Paginator:
+            def paginate(self, Bucket, **kwargs):
+                yield fake.list_objects_v2(Bucket, **kwargs)
+
+        return Paginator()
+
+
+class FakeLambda:
+    """Records invokes instead of calling Lambda"""
+
+    def __init__(self):
+        self.invokes = []
+
+    def invoke(self, **kwargs):
+        self.invokes.append(kwargs)
+        return {'StatusCode': 202}
+
+
+class FakeTable:
+    """In-memory DynamoDB table keyed on its key attributes; only attribute_(not_)exists conditions are evaluated"""
+
+    def __init__(self, client, name, key_names):
+        self.client = client
+        self.name = name
+        self.key_names = key_names
+        self.items = {}
+        self.updates = []
+        # FilterExpressions aren't parsed; tests that scan set the equivalent predicate here
+        self.scan_filter = None
+
+    def key_of(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    def check_condition(self, key, condition):
+        if not condition:
+            return
+        function, _, attribute = condition.rstrip(')').partition('(')
+        exists = key in self.items and attribute in self.items[key]
+        if (function == 'attribute_not_exists' and exists) or (function == 'attribute_exists' and not exists):
+            raise self.client.exceptions.ConditionalCheckFailedException(
+                {'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem'
+            )
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get(self.key_of(Key))
+        return {'Item': dict(item)} if item else {}
+
+    def put_item(self, Item, ConditionExpression=None, **kwargs):
+        key = self.key_of(Item)
+        self.check_condition(key, ConditionExpression)
+        self.items[key] = dict(Item)
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        self.items.pop(self.key_of(Key), None)
+        return {}
+
+    @contextlib.contextmanager
+    def batch_writer(self):
+        yield self
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, **kwargs):
+        # Only single-attribute equality: "name = :value"
+        attribute, _, placeholder = (part.strip() for part in KeyConditionExpression.partition('='))
+        value = ExpressionAttributeValues[placeholder]
+        return {'Items': [dict(item) for item in self.items.values() if item.get(attribute) == value]}
+
+    def scan(self, **kwargs):
+        items = [dict(item) for item in self.items.values() if self.scan_filter is None or self.scan_filter(item)]
+        return {'Items': items}
+
+    def update_item(self, **kwargs):
+        self.updates.append(kwargs)
+        return {'Attributes': {}}
+
+
+class FakeDynamoClient:
+    """The parts of dynamodb.meta.client that lambda_function uses"""
+
+    class exceptions:
+        class ConditionalCheckFailedException(Exception):
+            def __init__(self, response, operation_name):
+                super().__init__(operation_name)
+                self.response = response
+
+        class TransactionCanceledException(Exception):
+            def __init__(self, response, operation_name):
+                super().__init__(operation_name)
+                self.response = response
+
+    def __init__(self):
+        self.tables = {}
+
+    def transact_write_items(self, TransactItems):
+        reasons = []
+        for transact_item in TransactItems:
+            (action, request), = transact_item.items()
+            table = self.tables[request['TableName']]
+            key = table.key_of(request['Item'] if action == 'Put' else request['Key'])
+            try:
+                table.check_condition(key, request.get('ConditionExpression'))
+                reasons.append({'Code': 'None'})
+            except self.exceptions.ConditionalCheckFailedException:
+                reasons.append({'Code': 'ConditionalCheckFailed'})
+        if any(reason['Code'] != 'None' for reason in reasons):
+            raise self.exceptions.TransactionCanceledException(
+                {'Error': {'Code': 'TransactionCanceledException'}, 'CancellationReasons': reasons}, 'TransactWriteItems'
+            )
+        for transact_item in TransactItems:
+            (action, request), = transact_item.items()
+            table = self.tables[request['TableName']]
+            if action == 'Put':
+                table.items[table.key_of(request['Item'])] = dict(request['Item'])
+            else:
+                table.updates.append(request)
+
+
+class FakeDynamoDB:
+    def __init__(self):
+        self.meta = type('Meta', (), {'client': FakeDynamoClient()})()
+
+    def table(self, name, key_names):
+        fake_table = FakeTable(self.meta.client, name, key_names)
+        self.meta.client.tables[name] = fake_table
+        return fake_table
+
+
+# lambda_function table global -> key attributes, as in cloudformation-template.yaml
+DYNAMODB_TABLES = {
+    'billing_table': ['user_email'],
+    'billing_runs_table': ['run_id', 'entry_id'],
+    'job_claims_table': ['job_id'],
+    'usage_ledger_table': ['tenant_id', 'event_id'],
+}
+
+
+@pytest.fixture
+def dynamo(lf, monkeypatch):
+    """Replace DynamoDB with in-memory tables; returns {table global name: FakeTable}"""
+    fake = FakeDynamoDB()
+    monkeypatch.setattr(lf, 'dynamodb', fake)
+    tables = {}
+    for global_name, key_names in DYNAMODB_TABLES.items():
+        tables[global_name] = fake.table(getattr(lf, global_name).name, key_names)
+        monkeypatch.setattr(lf, global_name, tables[global_name])
+    return tables
+
+
+@pytest.fixture
+def lf(monkeypatch):
+    """lambda_function with S3 and Lambda replaced by in-memory fakes"""
+    monkeypatch.setattr(lambda_function, 's3', FakeS3())
+    monkeypatch.setattr(lambda_function, 'lambda_client', FakeLambda())
+    monkeypatch.setattr(lambda_function, '_rate_limit_buckets', {})
+    return lambda_function
+
+
+PASSKEY = 'test-passkey'
+STORAGE_BYTES = {'acme': 30 * 1024 * 1024, 'globex': 5 * 1024 * 1024, 'initech': 12 * 1024 * 1024}
+BILLING_USERS = {'acme': 'alice@example.com', 'globex': 'bob@example.com', 'initech': 'carol@example.com'}
+
+
+@pytest.fixture
+def billing(lf, dynamo, monkeypatch):
+    """Three tenants due 3, 1 and 1 storage tokens; returns the list worker events are dispatched to"""
+    monkeypatch.setattr(lf, 'billing_passkey_hash', hashlib.sha256(PASSKEY.encode('utf-8')).hexdigest())
+    monkeypatch.setattr(lf, 'get_tenant_storage_bytes', lambda storage_source, inventory_manifest=None: dict(STORAGE_BYTES))
+    monkeypatch.setattr(lf, 'load_tenant_billing_users', lambda: dict(BILLING_USERS))
+    dispatched = []
+    monkeypatch.setattr(lf, 'dispatch_worker_event', dispatched.append)
+    return dispatched
+
+
+@pytest.fixture
+def bill(lf):
+    """Call the bill endpoint with the test passkey; returns (status code, parsed body)"""
+    def call(body):
+        response = lf.lambda_handler({'type': 'bill', 'body': {'passkey': PASSKEY, **body}}, None)
+        return response['statusCode'], json.loads(response['body'])
+    return call
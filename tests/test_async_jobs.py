@@ -0,0 +1,95 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def local_jobs(lf, monkeypatch):
+    monkeypatch.setattr(lf, 'async_job_backend', 'local')
+    monkeypatch.setattr(lf, 'openai_api_key', 'test-key')
+    monkeypatch.setattr(lf, '_local_jobs', {})
+    monkeypatch.setattr(lf, '_local_job_claims', {})
+    return lf
+
+
+def call(lf, request_type, body):
+    response = lf.lambda_handler({'type': request_type, 'body': body}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def wait_for_job(lf, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while True:
+        status_code, job = call(lf, 'job_status', {'extension': 'acme', 'job_id': job_id})
+        assert status_code == 200
+        if job['status'] in ('succeeded', 'failed') or time.monotonic() > deadline:
+            return job
+        time.sleep(0.01)
+
+
+def test_submit_work_status_round_trip(local_jobs, monkeypatch):
+    lf = local_jobs
+
+    def fake_handle_llm(body, progress_callback=None):
+        progress_callback({'stage': 'generating'})
+        return lf.create_response(200, {'schema': {'title': body['prompt']}})
+
+    monkeypatch.setattr(lf, 'handle_llm', fake_handle_llm)
+
+    status_code, submitted = call(lf, 'llm', {'extension': 'acme', 'prompt': 'passenger', 'async': True})
+    assert status_code == 202
+    assert submitted['status'] == 'queued'
+
+    job = wait_for_job(lf, submitted['job_id'])
+    assert job['status'] == 'succeeded'
+    assert job['result'] == {'statusCode': 200, 'body': {'schema': {'title': 'passenger'}}}
+    assert [event['stage'] for event in job['progress']] == ['generating']
+    # The stored request may carry tokens and is never echoed back
+    assert 'request' not in job
+
+
+def test_duplicate_delivery_runs_job_once(local_jobs, monkeypatch):
+    lf = local_jobs
+    runs = []
+
+    def fake_handle_llm(body, progress_callback=None):
+        runs.append(body)
+        return lf.create_response(200, {})
+
+    monkeypatch.setattr(lf, 'handle_llm', fake_handle_llm)
+    job = {'job_id': 'a' * 32, 'tenant_id': 'acme', 'request_type': 'llm', 'status': 'queued',
+           'created_at': datetime.utcnow().isoformat(), 'progress': [], 'request': {'extension': 'acme'}}
+    lf.save_job(job)
+
+    worker_event = {'extension': 'acme', 'job_id': job['job_id']}
+    lf.handle_job_worker(worker_event)
+    lf.handle_job_worker(worker_event)
+
+    assert len(runs) == 1
+
+
+def test_claimed_job_never_marked_running_is_abandoned(local_jobs):
+    lf = local_jobs
+    job = {'job_id': 'b' * 32, 'tenant_id': 'acme', 'request_type': 'llm', 'status': 'queued',
+           'created_at': datetime.utcnow().isoformat(), 'progress': [], 'request': {}}
+    lf.save_job(job)
+    # The worker won the claim, then died before it could save the job as running
+    assert lf.claim_job('acme', job['job_id'])
+    status_code, status = call(lf, 'job_status', {'extension': 'acme', 'job_id': job['job_id']})
+    assert status['status'] == 'queued'
+
+    stale = datetime.utcnow() - timedelta(seconds=lf.async_job_timeout_seconds + 1)
+    lf._local_job_claims[job['job_id']] = stale.isoformat()
+    status_code, status = call(lf, 'job_status', {'extension': 'acme', 'job_id': job['job_id']})
+    assert status_code == 200
+    assert status['status'] == 'failed'
+    assert status['result']['statusCode'] == 504
+
+
+def test_unclaimed_queued_job_is_not_abandoned(local_jobs):
+    lf = local_jobs
+    created_at = (datetime.utcnow() - timedelta(hours=1)).isoformat()
+    job = {'job_id': 'c' * 32, 'tenant_id': 'acme', 'status': 'queued', 'created_at': created_at}
+    assert not lf.is_job_abandoned(job)
@@ -0,0 +1,79 @@
+from conftest import PASSKEY
+
+
+def debited_users(dynamo, run_id):
+    return sorted(
+        item['user_email'] for (item_run_id, entry_id), item in dynamo['billing_runs_table'].items.items()
+        if item_run_id == run_id and entry_id.startswith('debit#')
+    )
+
+
+def test_checkpointed_run_resumes_itself(lf, dynamo, billing, bill):
+    status_code, response = bill({'run_id': 'run-1', 'max_users': 1})
+
+    assert status_code == 202
+    assert response['remaining_users'] == 2
+    assert billing == [{'type': 'bill', 'body': {'passkey': PASSKEY, 'max_users': 1, 'run_id': 'run-1'}}]
+
+    # Run the continuations the way Lambda would, until one of them finishes the run
+    while billing:
+        lf.lambda_handler(billing.pop(0), None)
+
+    assert debited_users(dynamo, 'run-1') == ['alice@example.com', 'bob@example.com', 'carol@example.com']
+    header = lf.load_billing_run('run-1')
+    assert header['status'] == 'completed'
+    assert header['results']['billed_users'] == 3
+    assert header['results']['total_tokens_billed'] == 3 + 1 + 1
+
+
+def test_finished_run_does_not_resume(lf, dynamo, billing, bill):
+    status_code, response = bill({'run_id': 'run-2'})
+
+    assert status_code == 200
+    assert response['status'] == 'completed'
+    assert billing == []
+    # Rerunning the same run ID never bills anyone twice
+    status_code, response = bill({'run_id': 'run-2'})
+    assert response['results']['billed_users'] == 3
+    assert debited_users(dynamo, 'run-2') == ['alice@example.com', 'bob@example.com', 'carol@example.com']
+
+
+def open_fan_out_runs(item):
+    # Same predicate as the FilterExpression in collect_open_billing_runs
+    return item['entry_id'] == '#run' and item.get('status') == 'in_progress' and 'pass_id' in item
+
+
+def test_fan_out_collects_shards_and_redispatches_stalled_one(lf, dynamo, billing, bill):
+    dynamo['billing_runs_table'].scan_filter = open_fan_out_runs
+
+    status_code, response = bill({'run_id': 'run-3', 'mode': 'fan_out', 'shards': 2})
+
+    assert status_code == 202
+    shard_events = {event['body']['shard']: event for event in billing}
+    assert sorted(shard_events) == [0, 1] and all(event['type'] == 'bill_shard' for event in billing)
+    billing.clear()
+
+    # Shard 0 runs; shard 1's invocation is lost
+    lf.lambda_handler(shard_events[0], None)
+    status_code, response = bill({'mode': 'collect_billing_runs'})
+    assert response['results'] == {'runs_checked': 1, 'runs_completed': 0, 'runs_in_progress': 1, 'runs_failed': 0}
+    assert billing == []
+
+    # Once shard 1 has been silent for a whole function timeout, collection dispatches it again
+    header = lf.load_billing_run('run-3')
+    header['shard_dispatched_at'][1] = '2000-01-01T00:00:00'
+    lf.save_billing_run(header)
+    bill({'mode': 'collect_billing_runs'})
+    assert billing == [shard_events[1]]
+
+    lf.lambda_handler(billing.pop(), None)
+    status_code, response = bill({'mode': 'collect_billing_runs'})
+    assert response['results']['runs_completed'] == 1
+
+    header = lf.load_billing_run('run-3')
+    assert header['status'] == 'completed'
+    assert header['results']['billed_users'] == 3
+    assert header['results']['total_tokens_billed'] == 5
+    assert debited_users(dynamo, 'run-3') == ['alice@example.com', 'bob@example.com', 'carol@example.com']
+    # Nothing left open for the schedule
+    assert bill({'mode': 'collect_billing_runs'})[1]['results']['runs_checked'] == 0
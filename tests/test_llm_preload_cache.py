@@ -0,0 +1,46 @@
+import pytest
+
+
+@pytest.fixture
+def cache(lf, monkeypatch):
+    monkeypatch.setattr(lf, '_preload_cache', {})
+    return lf
+
+
+def store(lf, prompt, json_object):
+    lf.store_preload_cache('acme', 'v1', prompt, {'json_object': json_object, 'root_schema': 'passenger.json'})
+
+
+@pytest.mark.parametrize('cached_prompt, prompt', [
+    ('a passenger named John', 'passenger John'),
+    ('Please create a passenger called John', 'passenger named John'),
+    ('a customer named Alice Smith who is 30', 'customer Alice Smith, 30'),
+])
+def test_paraphrases_hit(cache, cached_prompt, prompt):
+    store(cache, cached_prompt, {'name': 'cached'})
+
+    entry, similarity = cache.lookup_preload_cache('acme', 'v1', prompt)
+
+    assert entry is not None, similarity
+    assert entry['json_object'] == {'name': 'cached'}
+
+
+@pytest.mark.parametrize('cached_prompt, prompt', [
+    ('passenger John', 'passenger Jane'),
+    ('flight to Paris', 'flight in Paris'),
+    ('a passenger with a dog', 'a passenger and a dog'),
+    ('flight from Paris to London', 'flight from London to Paris'),
+    ('a flight from Paris to London with 3 passengers', 'a flight from Paris to London with 4 passengers'),
+])
+def test_different_requests_miss(cache, cached_prompt, prompt):
+    store(cache, cached_prompt, {'name': 'cached'})
+
+    entry, similarity = cache.lookup_preload_cache('acme', 'v1', prompt)
+
+    assert entry is None
+
+
+def test_cache_is_scoped_to_schema_version(cache):
+    store(cache, 'a passenger named John', {'name': 'John'})
+
+    assert cache.lookup_preload_cache('acme', 'v2', 'a passenger named John') == (None, 0)
@@ -0,0 +1,73 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+PASSENGER_SCHEMA = {
+    '$id': 'passenger',
+    'title': 'Passenger',
+    'type': 'object',
+    'properties': {'name': {'type': 'string'}},
+    'required': ['name']
+}
+COMPLETION = json.dumps({'detected_schema': 'passenger', 'json_object': {'name': 'John'}})
+DELTAS = [COMPLETION[:20], COMPLETION[20:45], COMPLETION[45:]]
+
+
+@pytest.fixture
+def fake_openai(lf, monkeypatch):
+    """A local OpenAI stand-in that streams DELTAS as chat completion chunks"""
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            requests_seen.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for delta in DELTAS:
+                chunk = {'choices': [{'delta': {'content': delta}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(lf, 'openai_api_base', f'http://127.0.0.1:{server.server_port}')
+    monkeypatch.setattr(lf, 'openai_api_key', 'test-key')
+    yield requests_seen
+    server.shutdown()
+    server.server_close()
+
+
+def test_stream_openai_api_relays_each_delta(lf, fake_openai):
+    tokens = []
+    response = lf.stream_openai_api('system', 'user', tokens.append)
+
+    assert tokens == DELTAS
+    assert response == COMPLETION
+    assert fake_openai[0]['stream'] is True
+
+
+def test_llm_preload_events_stream_tokens_then_validated_result(lf, fake_openai, monkeypatch):
+    monkeypatch.setattr(lf, 'get_billing_user_for_tenant', lambda tenant_id: None)
+    lf.s3.put_object(Bucket=lf.bucket_name, Key='schemas/stream-test/passenger.json', Body=json.dumps(PASSENGER_SCHEMA))
+
+    events = list(lf.iter_llm_preload_events({'extension': 'stream-test', 'prompt': 'passenger John', 'no_cache': True}))
+
+    assert [event['event'] for event in events] == ['attempt', 'token', 'token', 'token', 'validated', 'result']
+    assert ''.join(event['delta'] for event in events if event['event'] == 'token') == COMPLETION
+    result = events[-1]
+    assert result['statusCode'] == 200
+    assert result['body']['json_object'] == {'name': 'John'}
+    assert result['body']['root_schema'] == 'passenger.json'
+
+
+def test_format_sse():
+    from lambda_function import format_sse
+
+    assert format_sse({'event': 'token', 'delta': 'x'}) == 'event: token\ndata: {"event": "token", "delta": "x"}\n\n'
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def clock(lf, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(lf.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(lf, 'rate_limits', lf.DEFAULT_RATE_LIMITS)
+    monkeypatch.setattr(lf, 'rate_limit_backend', 'local')
+    monkeypatch.setattr(lf, 'handle_llm_preload', lambda body: lf.create_response(200, {'json_object': {}}))
+    return now
+
+
+def preload(lf, extension='acme'):
+    return lf.lambda_handler({'type': 'llm-preload', 'body': {'extension': extension, 'prompt': 'passenger'}}, None)
+
+
+def test_eleventh_request_in_window_gets_429_with_retry_after(lf, clock):
+    # llm-preload allows a burst of 10, refilled at one request per second
+    for _ in range(10):
+        assert preload(lf)['statusCode'] == 200
+
+    response = preload(lf)
+
+    assert response['statusCode'] == 429
+    assert response['headers']['Retry-After'] == '1'
+    assert json.loads(response['body'])['retry_after'] == 1
+    # Other tenants have their own bucket
+    assert preload(lf, extension='globex')['statusCode'] == 200
+
+
+def test_bucket_refills_over_time(lf, clock):
+    for _ in range(10):
+        preload(lf)
+    assert preload(lf)['statusCode'] == 429
+
+    clock[0] += 1
+    assert preload(lf)['statusCode'] == 200
+    assert preload(lf)['statusCode'] == 429
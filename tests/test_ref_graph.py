@@ -0,0 +1,46 @@
+import json
+
+
+def schema(filename, body, schema_id=None):
+    return {'filename': filename, 'id': schema_id or filename, 'schema': body}
+
+
+SCHEMAS = [
+    schema('booking.json', {'properties': {
+        'passenger': {'$ref': 'passenger.json'},
+        'flight': {'$ref': 'https://example.com/schemas/Flight'},
+        'notes': {'$ref': '#/definitions/notes'}
+    }}),
+    schema('passenger.json', {'properties': {'address': {'$ref': 'ADDRESS.json'}}}),
+    schema('address.json', {'properties': {'owner': {'$ref': 'passenger.json'}}}),
+    schema('flight-v2.json', {'properties': {'aircraft': {'$ref': 'aircraft.json'}}},
+           schema_id='https://example.com/schemas/flight'),
+    schema('airport.json', {'type': 'object'}),
+]
+
+
+def test_build_ref_graph_resolves_filenames_ids_and_case(lf):
+    graph = lf.build_ref_graph(SCHEMAS)
+
+    assert graph['edges']['booking.json'] == ['flight-v2.json', 'passenger.json']
+    assert graph['edges']['passenger.json'] == ['address.json']
+    assert graph['reverse_edges']['passenger.json'] == ['address.json', 'booking.json']
+    assert graph['dangling'] == {'flight-v2.json': ['aircraft.json']}
+
+
+def test_closure_follows_transitive_refs_and_cycles(lf):
+    graph = lf.build_ref_graph(SCHEMAS)
+
+    assert lf.get_schema_closure(graph, 'booking') == ['booking.json', 'address.json', 'flight-v2.json', 'passenger.json']
+    # passenger -> address -> passenger is a cycle; the root is listed once
+    assert lf.get_schema_closure(graph, 'Passenger.json') == ['passenger.json', 'address.json']
+    assert lf.get_schema_closure(graph, 'airport.json') == ['airport.json']
+    assert lf.get_schema_closure(graph, 'missing.json') == []
+
+
+def test_stored_ref_graph_round_trips(lf):
+    graph = lf.build_ref_graph(SCHEMAS)
+    lf.s3.put_object(Bucket=lf.bucket_name, Key=lf.get_ref_graph_key('acme'), Body=json.dumps(graph))
+
+    assert lf.load_ref_graph('acme') == graph
+    assert lf.load_ref_graph('globex') is None
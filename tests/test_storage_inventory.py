@@ -0,0 +1,54 @@
+import csv
+import gzip
+import io
+import json
+
+
+def write_csv_gz(rows):
+    text = io.StringIO()
+    csv.writer(text).writerows(rows)
+    return gzip.compress(text.getvalue().encode('utf-8'))
+
+
+def test_scan_local_csv_inventory(lf, tmp_path):
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'data' / 'part-0.csv.gz').write_bytes(write_csv_gz([
+        ['bucket', 'schemas/acme/passenger.json', '100', 'true', 'false'],
+        ['bucket', 'schemas/acme/old%20flight.json', '40', 'false', 'false'],
+        ['bucket', 'schemas/acme/deleted.json', '', 'true', 'true'],
+        ['bucket', 'schemas/globex/order+line.json', '25', 'true', 'false'],
+        ['bucket', 'jobs/acme/job.json', '999', 'true', 'false'],
+    ]))
+    (tmp_path / 'data' / 'part-1.csv.gz').write_bytes(write_csv_gz([
+        ['bucket', 'schemas/acme/flight.json', '50', 'true', 'false'],
+    ]))
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps({
+        'fileFormat': 'CSV',
+        'fileSchema': 'Bucket, Key, Size, IsLatest, IsDeleteMarker',
+        'files': [{'key': 'data/part-0.csv.gz'}, {'key': 'data/part-1.csv.gz'}]
+    }))
+
+    # Only current, non-deleted objects under schemas/{tenant}/ count
+    assert lf.scan_inventory_storage_bytes(str(manifest)) == {'acme': 150, 'globex': 25}
+
+
+def test_scan_s3_csv_inventory(lf):
+    lf.s3.put_object(Bucket='inventory', Key='inv/data/part-0.csv.gz', Body=write_csv_gz([
+        ['bucket', 'schemas/acme/passenger.json', '2048'],
+    ]))
+    lf.s3.put_object(Bucket='inventory', Key='inv/manifest.json', Body=json.dumps({
+        'destinationBucket': 'arn:aws:s3:::inventory',
+        'fileFormat': 'CSV',
+        'fileSchema': 'Bucket, Key, Size',
+        'files': [{'key': 'inv/data/part-0.csv.gz'}]
+    }))
+
+    assert lf.scan_inventory_storage_bytes('s3://inventory/inv/manifest.json') == {'acme': 2048}
+
+
+def test_inventory_without_size_column_is_rejected(lf, tmp_path):
+    manifest = tmp_path / 'manifest.json'
+    manifest.write_text(json.dumps({'fileFormat': 'CSV', 'fileSchema': 'Bucket, Key', 'files': []}))
+
+    assert lf.scan_inventory_storage_bytes(str(manifest)) is None
@@ -0,0 +1,77 @@
+import pytest
+
+
+@pytest.fixture
+def ledger(lf, dynamo, monkeypatch):
+    monkeypatch.setattr(lf, 'usage_ledger_enabled', True)
+    return dynamo['usage_ledger_table']
+
+
+def test_debit_is_written_before_returning(lf, ledger):
+    assert lf.debit_tokens_from_user('alice@example.com', 10, 'llm-preload', tenant_id='acme')
+
+    (event,) = ledger.items.values()
+    assert event['tenant_id'] == 'acme'
+    assert event['user_email'] == 'alice@example.com'
+    assert event['operation_type'] == 'llm-preload'
+    assert event['tokens'] == 10
+    assert 'pending_shard' in event
+
+
+def test_storage_run_debits_go_through_the_ledger_once(lf, dynamo, ledger, billing, bill):
+    status_code, response = bill({'run_id': 'run-1'})
+    assert status_code == 200
+    assert response['results']['billed_users'] == 3
+    # Nothing touches token_balance directly; the rollup does that
+    assert dynamo['billing_table'].updates == []
+    assert sorted((tenant_id, event_id) for tenant_id, event_id in ledger.items) == [
+        ('acme', 'storage#run-1'), ('globex', 'storage#run-1'), ('initech', 'storage#run-1')
+    ]
+
+    # A retry pass that lost its debit records still can't bill anyone twice
+    for key in [key for key in dynamo['billing_runs_table'].items if key[1].startswith('debit#')]:
+        del dynamo['billing_runs_table'].items[key]
+    header = lf.load_billing_run('run-1')
+    header['status'] = 'completed_with_failures'
+    lf.save_billing_run(header)
+    status_code, response = bill({'run_id': 'run-1'})
+    assert response['results']['already_billed'] == 3
+    assert len(ledger.items) == 3
+
+
+def test_rollup_applies_storage_events_to_balances(lf, dynamo, ledger, billing, bill):
+    bill({'run_id': 'run-2'})
+
+    summary = lf.rollup_usage_ledger()
+
+    assert summary == {'users': 3, 'events_rolled_up': 3, 'tokens_rolled_up': 5, 'failed_batches': 0}
+    daily_aggregates = [update for update in ledger.updates if update['Key']['event_id'].startswith('daily#')]
+    assert len(daily_aggregates) == 3
+
+
+def test_buffered_debit_is_acknowledged_after_the_ledger_write(lf, dynamo, monkeypatch):
+    monkeypatch.setattr(lf, 'debit_buffer_enabled', True)
+    monkeypatch.setattr(lf, 'get_billing_user_for_tenant', lambda tenant_id: 'alice@example.com')
+    ledger = dynamo['usage_ledger_table']
+
+    for _ in range(3):
+        response = lf.handle_debit_tokens({'extension': 'acme', 'tokens': 1, 'operation_type': 'pageload'})
+        assert response['statusCode'] == 202
+
+    assert len(ledger.items) == 3
+    assert dynamo['billing_table'].updates == []
+    # The rollup applies all three in one balance update for the billing user
+    assert lf.rollup_usage_ledger()['tokens_rolled_up'] == 3
+
+
+def test_buffered_debit_falls_back_to_a_direct_debit(lf, dynamo, monkeypatch):
+    monkeypatch.setattr(lf, 'debit_buffer_enabled', True)
+    monkeypatch.setattr(lf, 'get_billing_user_for_tenant', lambda tenant_id: 'alice@example.com')
+    monkeypatch.setattr(lf, 'append_usage_events', lambda *args, **kwargs: False)
+
+    response = lf.handle_debit_tokens({'extension': 'acme', 'tokens': 2})
+
+    assert response['statusCode'] == 200
+    (update,) = dynamo['billing_table'].updates
+    assert update['Key'] == {'user_email': 'alice@example.com'}
+    assert update['ExpressionAttributeValues'][':tokens'] == 2